@@ -8,12 +8,9 @@ def prob_action(policy_net, memory, tau, batch_size, device):
     states = states.to(device)
     actions = actions.to(device)
 
-    policy = 0
-    for ens_num in range(policy_net.get_num_ensembles()):
-        with torch.no_grad():
-            policy += F.softmax(policy_net(states,
-                                           ens_num=ens_num) / tau, dim=1)
-    policy /= policy_net.get_num_ensembles()
+    with torch.no_grad():
+        q_vals = policy_net.ensemble_q_values(states)
+    policy = F.softmax(q_vals / tau, dim=2).mean(dim=0)
 
     prob_actions = policy.gather(1, actions)
     return torch.sum(prob_actions) / batch_size
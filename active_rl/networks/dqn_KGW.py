@@ -59,4 +59,16 @@ class MC_DQN(nn.Module):
         if last_layer:
             return self.fc2(self.dropout(x)), x
         else:
-            return self.fc2(self.dropout(x))
\ No newline at end of file
+            return self.fc2(self.dropout(x))
+
+    def mc_q_values(self, x, num_samples=10):
+        """Q-values under ``num_samples`` dropout masks as (samples, batch,
+        actions). The convolutional trunk runs once; only the dropout and
+        ``fc2`` are evaluated per sample, as one batched matmul."""
+        _, x = self.forward(x, last_layer=True)
+        return self.mc_q_values_from_features(x, num_samples)
+
+    def mc_q_values_from_features(self, features, num_samples=10):
+        """``mc_q_values`` for precomputed ``last_layer`` features."""
+        x = features.float().unsqueeze(0).expand(num_samples, -1, -1)
+        return self.fc2(self.dropout(x))
\ No newline at end of file
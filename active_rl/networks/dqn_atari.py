@@ -122,6 +122,18 @@ class MC_DQN(nn.Module):
         else:
             return self.fc2(self.dropout(x))
 
+    def mc_q_values(self, x, num_samples=10):
+        """Q-values under ``num_samples`` dropout masks as (samples, batch,
+        actions). The convolutional trunk runs once; only the dropout and
+        ``fc2`` are evaluated per sample, as one batched matmul."""
+        _, x = self.forward(x, last_layer=True)
+        return self.mc_q_values_from_features(x, num_samples)
+
+    def mc_q_values_from_features(self, features, num_samples=10):
+        """``mc_q_values`` for precomputed ``last_layer`` features."""
+        x = features.float().unsqueeze(0).expand(num_samples, -1, -1)
+        return self.fc2(self.dropout(x))
+
 
 class ENS_DQN(nn.Module):
     def __init__(self, n_actions=4, num_networks=5):
@@ -165,6 +177,9 @@ class ENS_DQN(nn.Module):
             net = self.ensembles[ens_num]
             return net(x, last_layer=last_layer)
 
+    def ensemble_q_values(self, x):
+        return torch.stack([net(x) for net in self.ensembles])
+
     def get_num_ensembles(self):
         return len(self.ensembles)
 
@@ -194,6 +209,99 @@ class ENS_DQN_Large(ENS_DQN):
             self.ensembles.append(new_net)
 
 
+class BatchedENS_DQN(nn.Module):
+    """ENS_DQN with the members' weights stacked into single tensors.
+
+    The first convolution of all members is one convolution with
+    ``num_networks * 32`` filters, the later ones are grouped convolutions
+    and the linear layers are batched matrix multiplies, so
+    ``ensemble_q_values`` returns the (members, batch, actions) Q-values of
+    the whole ensemble in one pass. ``forward(x, ens_num=i)`` evaluates a
+    single member through slices of the stacked weights.
+    """
+
+    def __init__(self, n_actions=4, num_networks=5):
+        super(BatchedENS_DQN, self).__init__()
+        self.num_networks = num_networks
+        self.n_actions = n_actions
+        members = [DQN(n_actions) for _ in range(num_networks)]
+        self.conv1 = nn.Parameter(torch.cat([m.conv1.weight for m in members]))
+        self.conv2 = nn.Parameter(torch.cat([m.conv2.weight for m in members]))
+        self.conv3 = nn.Parameter(torch.cat([m.conv3.weight for m in members]))
+        self.fc1_weight = nn.Parameter(torch.stack(
+            [m.fc1.weight.t() for m in members]))
+        self.fc1_bias = nn.Parameter(torch.stack(
+            [m.fc1.bias.unsqueeze(0) for m in members]))
+        self.fc2_weight = nn.Parameter(torch.stack(
+            [m.fc2.weight.t() for m in members]))
+        self.fc2_bias = nn.Parameter(torch.stack(
+            [m.fc2.bias.unsqueeze(0) for m in members]))
+
+    def init_weights(self, m):
+        if m is self:
+            members = [DQN(self.n_actions) for _ in range(self.num_networks)]
+            for net in members:
+                net.apply(net.init_weights)
+            self.load_state_dict([net.state_dict() for net in members])
+
+    def ensemble_q_values(self, x, last_layer=False):
+        num_ens = self.num_networks
+        x = x.float() / 255.
+        x = F.relu(F.conv2d(x, self.conv1, stride=4))
+        x = F.relu(F.conv2d(x, self.conv2, stride=2, groups=num_ens))
+        x = F.relu(F.conv2d(x, self.conv3, stride=1, groups=num_ens))
+        x = x.view(x.size(0), num_ens, -1).transpose(0, 1)
+        x = F.relu(torch.baddbmm(self.fc1_bias, x, self.fc1_weight))
+        q_values = torch.baddbmm(self.fc2_bias, x, self.fc2_weight)
+        if last_layer:
+            return q_values, x
+        return q_values
+
+    def _member(self, x, i, last_layer=False):
+        x = x.float() / 255.
+        x = F.relu(F.conv2d(x, self.conv1[32 * i: 32 * (i + 1)], stride=4))
+        x = F.relu(F.conv2d(x, self.conv2[64 * i: 64 * (i + 1)], stride=2))
+        x = F.relu(F.conv2d(x, self.conv3[64 * i: 64 * (i + 1)], stride=1))
+        x = F.relu(torch.addmm(self.fc1_bias[i], x.view(x.size(0), -1),
+                               self.fc1_weight[i]))
+        q_values = torch.addmm(self.fc2_bias[i], x, self.fc2_weight[i])
+        if last_layer:
+            return q_values, x
+        return q_values
+
+    def forward(self, x, tau=0.1, ens_num=None, last_layer=False,
+                q_value=False):
+        if ens_num is None:
+            q_values = self.ensemble_q_values(x)
+            if q_value:
+                return q_values.mean(dim=0)
+            return F.softmax(q_values / tau, dim=2).mean(dim=0)
+        else:
+            return self._member(x, ens_num, last_layer=last_layer)
+
+    def get_num_ensembles(self):
+        return self.num_networks
+
+    def load_state_dict(self, state_dict, strict=True):
+        """Also accepts the list of member state dicts saved by ENS_DQN."""
+        if isinstance(state_dict, (list, tuple)):
+            state_dict = {
+                'conv1': torch.cat([d['conv1.weight'] for d in state_dict]),
+                'conv2': torch.cat([d['conv2.weight'] for d in state_dict]),
+                'conv3': torch.cat([d['conv3.weight'] for d in state_dict]),
+                'fc1_weight': torch.stack(
+                    [d['fc1.weight'].t() for d in state_dict]),
+                'fc1_bias': torch.stack(
+                    [d['fc1.bias'].unsqueeze(0) for d in state_dict]),
+                'fc2_weight': torch.stack(
+                    [d['fc2.weight'].t() for d in state_dict]),
+                'fc2_bias': torch.stack(
+                    [d['fc2.bias'].unsqueeze(0) for d in state_dict]),
+            }
+        return super(BatchedENS_DQN, self).load_state_dict(
+            state_dict, strict=strict)
+
+
 class Bootstrap_DQN(nn.Module):
     def __init__(self, n_actions=4, num_networks=5):
         super(Bootstrap_DQN, self).__init__()
@@ -214,14 +322,21 @@ class Bootstrap_DQN(nn.Module):
             torch.nn.init.kaiming_normal_(m.weight, nonlinearity='relu')
             # m.bias.data.fill_(0.1)
 
-    def forward(self, x, training=False):
+    def _trunk(self, x):
         x = x.float() / 255.
         x = F.relu(self.conv1(x))
         x = F.relu(self.conv2(x))
         x = F.relu(self.conv3(x))
-        x = F.relu(self.fc1(x.view(x.size(0), -1)))
+        return F.relu(self.fc1(x.view(x.size(0), -1)))
 
-        if training:
+    def forward(self, x, training=False, ens_num=None, last_layer=False):
+        x = self._trunk(x)
+
+        if ens_num is not None:
+            if last_layer:
+                return self.bootstrap[ens_num](x), x
+            return self.bootstrap[ens_num](x)
+        elif training:
             return [self.bootstrap[i](x) for i in range(len(self.bootstrap))]
         else:
             q_vals = 0
@@ -229,6 +344,15 @@ class Bootstrap_DQN(nn.Module):
                 q_vals += self.bootstrap[i](x)
             return q_vals / len(self.bootstrap)
 
+    def ensemble_q_values(self, x):
+        """Q-values of every head as (heads, batch, actions); the shared
+        trunk runs once."""
+        x = self._trunk(x)
+        return torch.stack([head(x) for head in self.bootstrap])
+
+    def get_num_ensembles(self):
+        return len(self.bootstrap)
+
 
 class SmallSharingBootstrap_DQN(nn.Module):
     def __init__(self, n_actions=4, num_networks=5):
@@ -255,13 +379,23 @@ class SmallSharingBootstrap_DQN(nn.Module):
             torch.nn.init.kaiming_normal_(m.weight, nonlinearity='relu')
             # m.bias.data.fill_(0.1)
 
-    def forward(self, x, training=False):
+    def _shared(self, x):
         x = x.float() / 255.
-        x = F.relu(self.conv1(x))
-        x = [F.relu(self.conv2[i](x)) for i in range(len(self.bootstrap))]
-        x = [F.relu(self.conv3[i](x[i])) for i in range(len(self.bootstrap))]
-        x = [F.relu(self.fc1[i](x[i].view(x[i].size(0), -1)))
-             for i in range(len(self.bootstrap))]
+        return F.relu(self.conv1(x))
+
+    def _branch(self, x, i):
+        x = F.relu(self.conv2[i](x))
+        x = F.relu(self.conv3[i](x))
+        return F.relu(self.fc1[i](x.view(x.size(0), -1)))
+
+    def forward(self, x, training=False, ens_num=None, last_layer=False):
+        x = self._shared(x)
+        if ens_num is not None:
+            x = self._branch(x, ens_num)
+            if last_layer:
+                return self.bootstrap[ens_num](x), x
+            return self.bootstrap[ens_num](x)
+        x = [self._branch(x, i) for i in range(len(self.bootstrap))]
 
         if training:
             return [self.bootstrap[i](x[i]) for i in range(len(self.bootstrap))]
@@ -271,6 +405,16 @@ class SmallSharingBootstrap_DQN(nn.Module):
                 q_vals += self.bootstrap[i](x[i])
             return q_vals / len(self.bootstrap)
 
+    def ensemble_q_values(self, x):
+        """Q-values of every head as (heads, batch, actions); the shared
+        layers run once."""
+        x = self._shared(x)
+        return torch.stack([self.bootstrap[i](self._branch(x, i))
+                            for i in range(len(self.bootstrap))])
+
+    def get_num_ensembles(self):
+        return len(self.bootstrap)
+
 
 class IndependentBootstrap_DQN(nn.Module):
     def __init__(self, n_actions=4, num_networks=5):
@@ -299,13 +443,23 @@ class IndependentBootstrap_DQN(nn.Module):
             torch.nn.init.kaiming_normal_(m.weight, nonlinearity='relu')
             # m.bias.data.fill_(0.1)
 
-    def forward(self, x, training=False):
-        x = x.float() / 255.
-        x = [F.relu(self.conv1[i](x)) for i in range(len(self.bootstrap))]
-        x = [F.relu(self.conv2[i](x[i])) for i in range(len(self.bootstrap))]
-        x = [F.relu(self.conv3[i](x[i])) for i in range(len(self.bootstrap))]
-        x = [F.relu(self.fc1[i](x[i].view(x[i].size(0), -1)))
-             for i in range(len(self.bootstrap))]
+    def _shared(self, x):
+        return x.float() / 255.
+
+    def _branch(self, x, i):
+        x = F.relu(self.conv1[i](x))
+        x = F.relu(self.conv2[i](x))
+        x = F.relu(self.conv3[i](x))
+        return F.relu(self.fc1[i](x.view(x.size(0), -1)))
+
+    def forward(self, x, training=False, ens_num=None, last_layer=False):
+        x = self._shared(x)
+        if ens_num is not None:
+            x = self._branch(x, ens_num)
+            if last_layer:
+                return self.bootstrap[ens_num](x), x
+            return self.bootstrap[ens_num](x)
+        x = [self._branch(x, i) for i in range(len(self.bootstrap))]
 
         if training:
             return [self.bootstrap[i](x[i]) for i in range(len(self.bootstrap))]
@@ -315,6 +469,16 @@ class IndependentBootstrap_DQN(nn.Module):
                 q_vals += self.bootstrap[i](x[i])
             return q_vals / len(self.bootstrap)
 
+    def ensemble_q_values(self, x):
+        """Q-values of every head as (heads, batch, actions); the shared
+        layers run once."""
+        x = self._shared(x)
+        return torch.stack([self.bootstrap[i](self._branch(x, i))
+                            for i in range(len(self.bootstrap))])
+
+    def get_num_ensembles(self):
+        return len(self.bootstrap)
+
 
 class ENS_DQN_V2(nn.Module):
     def __init__(self, n_actions=4, num_networks=5):
@@ -358,6 +522,9 @@ class ENS_DQN_V2(nn.Module):
             net = self.ensembles[ens_num]
             return net(x, last_layer=last_layer)
 
+    def ensemble_q_values(self, x):
+        return torch.stack([net(x) for net in self.ensembles])
+
     def get_num_ensembles(self):
         return len(self.ensembles)
 
@@ -11,69 +11,21 @@ def BALD(prob_N_K_C):
 
 
 def mc_entropy(policy_net, states, tau=0.1, batch_size=128, num_iters=10, device='cuda'):
-    entropy = torch.zeros((states.shape[0]), dtype=torch.float)
-    for i in range(0, states.shape[0], batch_size):
-        if i + batch_size < states.shape[0]:
-            batch_len = batch_size
-        else:
-            batch_len = states.shape[0] - i
-        next_states = states[i: i + batch_len, :, :].to(device)
-        with torch.no_grad():
-            q_values = policy_net(next_states)
-            policy = to_policy(q_values, tau=tau)
-        for _ in range(num_iters - 1):
-            with torch.no_grad():
-                q_values = policy_net(next_states)
-                policy += to_policy(q_values, tau=tau)
-        policy /= num_iters
-        current_entropy = - torch.sum(policy * torch.log(policy + 1e-8), 1)
-        entropy[i: i + batch_len] = current_entropy.to('cpu')
-    return entropy
+    return mc_uncertainty(policy_net, states, metrics=('entropy',), tau=tau,
+                          batch_size=batch_size, num_iters=num_iters,
+                          device=device)['entropy']
 
 
 def mc_BALD(policy_net, states, tau=0.1, batch_size=128, num_iters=10, device='cuda'):
-    entropy = mc_entropy(policy_net, states, tau=tau,
-                         batch_size=batch_size, num_iters=num_iters, device=device)
-    cond_entropy = torch.zeros((states.shape[0]), dtype=torch.float)
-    for i in range(0, states.shape[0], batch_size):
-        if i + batch_size < states.shape[0]:
-            batch_len = batch_size
-        else:
-            batch_len = states.shape[0] - i
-        next_states = states[i: i + batch_len, :, :].to(device)
-        with torch.no_grad():
-            q_values = policy_net(next_states)
-            policy = to_policy(q_values, tau=tau)
-            current_cond_entropy = torch.sum(policy * torch.log(policy), 1)
-        for _ in range(num_iters - 1):
-            with torch.no_grad():
-                q_values = policy_net(next_states)
-                policy = to_policy(q_values, tau=tau)
-                current_cond_entropy += torch.sum(policy *
-                                                  torch.log(policy + 1e-8), 1)
-        current_cond_entropy /= num_iters
-        cond_entropy[i: i + batch_len] = current_cond_entropy.to('cpu')
-    return entropy + cond_entropy
+    return mc_uncertainty(policy_net, states, metrics=('BALD',), tau=tau,
+                          batch_size=batch_size, num_iters=num_iters,
+                          device=device)['BALD']
 
 
 def mc_var_ratio(policy_net, states, tau=0.1, batch_size=128, num_iters=10, device='cuda'):
-    var_ratio = torch.zeros((states.shape[0]), dtype=torch.float)
-    for i in range(0, states.shape[0], batch_size):
-        if i + batch_size < states.shape[0]:
-            batch_len = batch_size
-        else:
-            batch_len = states.shape[0] - i
-        next_states = states[i: i + batch_len, :, :].to(device)
-        actions = torch.zeros((next_states.shape[0], num_iters))
-        for j in range(num_iters - 1):
-            with torch.no_grad():
-                q_values = policy_net(next_states)
-                actions[:, j] = torch.argmax(q_values, dim=1)
-        modal = torch.mode(actions, dim=1)[0].unsqueeze(1)
-        frequency = torch.sum(actions == modal, 1)
-        current_var_ration = 1 - frequency / num_iters
-        var_ratio[i: i + batch_len] = current_var_ration
-    return var_ratio
+    return mc_uncertainty(policy_net, states, metrics=('var_ratio',), tau=tau,
+                          batch_size=batch_size, num_iters=num_iters,
+                          device=device)['var_ratio']
 
 
 def mc_random(policy_net, states, tau=0.1, batch_size=128, num_iters=10, device='cuda'):
@@ -84,50 +36,147 @@ def to_policy(q_values, tau=0.1):
     return F.softmax(q_values / tau, dim=1)
 
 
-def ens_entropy(policy_net, states, tau=0.1, batch_size=128, device='cuda'):
-    entropy = torch.zeros((states.shape[0]), dtype=torch.float)
-    for i in range(0, states.shape[0], batch_size):
-        if i + batch_size < states.shape[0]:
-            batch_len = batch_size
+def ens_q_values(policy_net, states):
+    """Q-values of every ensemble member stacked as (members, batch, actions)."""
+    return policy_net.ensemble_q_values(states)
+
+
+def ens_var_ratio_from_q(q_vals):
+    num_ens = q_vals.shape[0]
+    actions = torch.argmax(q_vals, dim=2)
+    modal = torch.mode(actions, dim=0)[0].unsqueeze(0)
+    frequency = torch.sum(actions == modal, 0)
+    return 1 - frequency.float() / num_ens
+
+
+TAU_METRICS = ('entropy', 'BALD')
+
+
+def policy_metrics_from_q(q_vals, metrics, tau=0.1):
+    """Entropy and BALD of the policies of a (M, B, A) Q stack at one tau."""
+    out = {}
+    policies = F.softmax(q_vals / tau, dim=2)
+    policy = policies.mean(dim=0)
+    entropy = - torch.sum(policy * torch.log(policy + 1e-8), 1)
+    if 'entropy' in metrics:
+        out['entropy'] = entropy
+    if 'BALD' in metrics:
+        cond_entropy = torch.sum(
+            policies * torch.log(policies + 1e-8), 2).mean(dim=0)
+        out['BALD'] = entropy + cond_entropy
+    return out
+
+
+def ens_metrics_from_q(q_vals, metrics, tau=0.1):
+    """Derives the requested uncertainty metrics from a (M, B, A) Q stack.
+
+    When ``tau`` is a list, entropy and BALD are (num_tau, B) matrices with
+    one row per temperature, all computed from the same Q-values.
+    """
+    num_ens = q_vals.shape[0]
+    out = {}
+    tau_metrics = [metric for metric in metrics if metric in TAU_METRICS]
+    if tau_metrics:
+        if isinstance(tau, (list, tuple)):
+            rows = [policy_metrics_from_q(q_vals, tau_metrics, tau=t)
+                    for t in tau]
+            for metric in tau_metrics:
+                out[metric] = torch.stack([row[metric] for row in rows])
         else:
-            batch_len = states.shape[0] - i
-        next_states = states[i: i + batch_len, :4, :].to(device)
-        with torch.no_grad():
-            q_values = policy_net(next_states, ens_num=0)
-            policy = to_policy(q_values, tau=tau)
-        for j in range(1, policy_net.get_num_ensembles()):
-            with torch.no_grad():
-                q_values = policy_net(next_states, ens_num=j)
-                policy += to_policy(q_values, tau=tau)
-        policy /= policy_net.get_num_ensembles()
-        current_entropy = - torch.sum(policy * torch.log(policy + 1e-8), 1)
-        entropy[i: i + batch_len] = current_entropy.to('cpu')
-    return entropy
+            out.update(policy_metrics_from_q(q_vals, tau_metrics, tau=tau))
+    if 'var_ratio' in metrics:
+        out['var_ratio'] = ens_var_ratio_from_q(q_vals)
+    if 'SNR' in metrics or 'N2S' in metrics:
+        expected_q_vals = q_vals.mean(dim=0)
+        sample_var = torch.sum((q_vals - expected_q_vals)
+                               ** 2, dim=0) / (num_ens - 1)
+        if 'SNR' in metrics:
+            out['SNR'] = torch.sum(sample_var / (expected_q_vals ** 2 + 1e-8),
+                                   dim=1) / sample_var.size(1)
+        if 'N2S' in metrics:
+            out['N2S'] = torch.sum(
+                sample_var / (expected_q_vals ** 2 + 1e-6), dim=1)
+    if 'n2s_action_gap' in metrics:
+        expected_q_vals = q_vals.mean(dim=0)
+        top_actions = torch.topk(expected_q_vals, 2, dim=1)[1]
+        q_vals_difference = \
+            q_vals.gather(2, top_actions[:, 0:1].expand(num_ens, -1, 1)) - \
+            q_vals.gather(2, top_actions[:, 1:2].expand(num_ens, -1, 1))
+        expected_q_vals_difference = q_vals_difference.mean(dim=0)
+        sample_var = torch.sum((q_vals_difference - expected_q_vals_difference)
+                               ** 2, dim=0) / (num_ens - 1)
+        out['n2s_action_gap'] = torch.sum(
+            sample_var / (expected_q_vals_difference ** 2 + 1e-6), dim=1)
+    return out
 
 
-def ens_BALD(policy_net, states, tau=0.1, batch_size=128, device='cuda'):
-    entropy = ens_entropy(policy_net, states, tau=tau,
-                          batch_size=batch_size, device=device)
-    cond_entropy = torch.zeros((states.shape[0]), dtype=torch.float)
-    for i in range(0, states.shape[0], batch_size):
-        if i + batch_size < states.shape[0]:
-            batch_len = batch_size
+ENS_METRICS = ('entropy', 'BALD', 'var_ratio', 'SNR', 'N2S', 'n2s_action_gap')
+
+
+def ens_uncertainty(policy_net, states, metrics=('BALD',), tau=0.1,
+                    batch_size=128, device='cuda', num_channels=None):
+    """Computes several ensemble acquisition metrics in one pass.
+
+    Every member runs once per chunk of ``batch_size`` states and all of
+    ``metrics`` (a subset of ``ENS_METRICS``) are derived from the same
+    stacked Q-values. Returns a dict from metric name to an (N,) tensor, or
+    to a (num_tau, N) matrix for entropy and BALD when ``tau`` is a list.
+    Only the first ``num_channels`` channels of each state are fed to the
+    network when it is given.
+    """
+    return _uncertainty(lambda x: ens_q_values(policy_net, x), states,
+                        metrics, tau, batch_size, device, num_channels)
+
+
+def _uncertainty(q_values, states, metrics, tau, batch_size, device,
+                 num_channels=None):
+    for metric in metrics:
+        if metric not in ENS_METRICS:
+            raise ValueError('unknown ensemble metric: %s' % metric)
+    num_states = states.shape[0]
+    scores = {}
+    for metric in metrics:
+        if metric in TAU_METRICS and isinstance(tau, (list, tuple)):
+            shape = (len(tau), num_states)
         else:
-            batch_len = states.shape[0] - i
-        next_states = states[i: i + batch_len, :4].to(device)
+            shape = (num_states,)
+        scores[metric] = torch.zeros(shape, dtype=torch.float)
+    for i in range(0, num_states, batch_size):
+        next_states = states[i: i + batch_size]
+        if num_channels is not None:
+            next_states = next_states[:, :num_channels]
+        next_states = next_states.to(device)
         with torch.no_grad():
-            q_values = policy_net(next_states, ens_num=0)
-            policy = to_policy(q_values, tau=tau)
-            current_cond_entropy = torch.sum(policy * torch.log(policy), 1)
-        for j in range(1, policy_net.get_num_ensembles()):
-            with torch.no_grad():
-                q_values = policy_net(next_states, ens_num=j)
-                policy = to_policy(q_values, tau=tau)
-                current_cond_entropy += torch.sum(policy *
-                                                  torch.log(policy + 1e-8), 1)
-        current_cond_entropy /= policy_net.get_num_ensembles()
-        cond_entropy[i: i + batch_len] = current_cond_entropy.to('cpu')
-    return entropy + cond_entropy
+            q_vals = q_values(next_states)
+            current = ens_metrics_from_q(q_vals, metrics, tau=tau)
+        for metric in metrics:
+            scores[metric][..., i: i + next_states.shape[0]] = \
+                current[metric].to('cpu')
+    return scores
+
+
+def mc_q_values(policy_net, states, num_iters=10):
+    """Q-values of ``num_iters`` dropout samples as (samples, batch, actions)."""
+    return policy_net.mc_q_values(states, num_iters)
+
+
+def mc_uncertainty(policy_net, states, metrics=('BALD',), tau=0.1,
+                   batch_size=128, num_iters=10, device='cuda'):
+    """``ens_uncertainty`` with MC-dropout samples in place of members."""
+    return _uncertainty(lambda x: mc_q_values(policy_net, x, num_iters),
+                        states, metrics, tau, batch_size, device)
+
+
+def ens_entropy(policy_net, states, tau=0.1, batch_size=128, device='cuda'):
+    return ens_uncertainty(policy_net, states, metrics=('entropy',), tau=tau,
+                           batch_size=batch_size, device=device,
+                           num_channels=4)['entropy']
+
+
+def ens_BALD(policy_net, states, tau=0.1, batch_size=128, device='cuda'):
+    return ens_uncertainty(policy_net, states, metrics=('BALD',), tau=tau,
+                           batch_size=batch_size, device=device,
+                           num_channels=4)['BALD']
 
 
 def ens_BALD_wrapper(policy_net, tau, batch_size, device):
@@ -430,81 +479,18 @@ def ens_TD_no_target(policy_net, memory, batch_size=128, GAMMA=0.99,
 
 
 def ens_SNR(policy_net, states, tau=0.1, batch_size=128, device='cuda'):
-    SNR = torch.zeros((states.shape[0]), dtype=torch.float)
-    for i in range(0, states.shape[0], batch_size):
-        if i + batch_size < states.shape[0]:
-            batch_len = batch_size
-        else:
-            batch_len = states.shape[0] - i
-        next_states = states[i: i + batch_len, :, :].to(device)
-        sum_q = 0
-        sum_q_2 = 0
-        num_ens = policy_net.get_num_ensembles()
-        for j in range(num_ens):
-            with torch.no_grad():
-                q_values = policy_net(next_states, ens_num=j)
-                sum_q += q_values
-                sum_q_2 += q_values ** 2
-        sample_var = (sum_q_2 - (sum_q ** 2) / num_ens) / (num_ens - 1)
-        n_actions = sample_var.size(1)
-        cur_SNR = torch.sum(sample_var / ((sum_q / num_ens)
-                                          ** 2 + 1e-8), dim=1) / n_actions
-        SNR[i: i + batch_len] = cur_SNR.to('cpu')
-    return SNR
+    return ens_uncertainty(policy_net, states, metrics=('SNR',), tau=tau,
+                           batch_size=batch_size, device=device)['SNR']
 
 
 def ens_N2S(policy_net, states, tau=0.1, batch_size=128, device='cuda'):
-    n2s = torch.zeros((states.shape[0]), dtype=torch.float)
-    for i in range(0, states.shape[0], batch_size):
-        if i + batch_size < states.shape[0]:
-            batch_len = batch_size
-        else:
-            batch_len = states.shape[0] - i
-        next_states = states[i: i + batch_len, :, :].to(device)
-        q_vals = []
-        num_ens = policy_net.get_num_ensembles()
-        for j in range(num_ens):
-            with torch.no_grad():
-                q_vals.append(policy_net(next_states, ens_num=j))
-        q_vals = torch.stack(q_vals)
-        expected_q_vals = torch.sum(q_vals, dim=0) / num_ens
-        sample_var = torch.sum((q_vals - expected_q_vals)
-                               ** 2, dim=0) / (num_ens - 1)
-        n2s_ratio = sample_var / (expected_q_vals ** 2 + 1e-6)
-        n2s[i: i + batch_len] = torch.sum(n2s_ratio, dim=1).to('cpu')
-    return n2s
+    return ens_uncertainty(policy_net, states, metrics=('N2S',), tau=tau,
+                           batch_size=batch_size, device=device)['N2S']
 
 
 def ens_n2s_action_gap(policy_net, states, tau=0.1, batch_size=128, device='cuda'):
-    n2s = torch.zeros((states.shape[0]), dtype=torch.float)
-    for i in range(0, states.shape[0], batch_size):
-        if i + batch_size < states.shape[0]:
-            batch_len = batch_size
-        else:
-            batch_len = states.shape[0] - i
-        next_states = states[i: i + batch_len, :, :].to(device)
-        q_vals = []
-        num_ens = policy_net.get_num_ensembles()
-        for j in range(num_ens):
-            with torch.no_grad():
-                q_vals.append(policy_net(next_states, ens_num=j))
-        q_vals = torch.stack(q_vals)
-        expected_q_vals = torch.sum(q_vals, dim=0) / num_ens
-        top_actions = torch.argsort(
-            expected_q_vals, dim=1, descending=True)[:, :2]
-        a1_q_vals = q_vals.gather(
-            2, top_actions[:, 0:1].unsqueeze(0).expand_as(q_vals[:, :, 0:1]))
-        a2_q_vals = q_vals.gather(
-            2, top_actions[:, 1:2].unsqueeze(0).expand_as(q_vals[:, :, 0:1]))
-        q_vals_difference = a1_q_vals - a2_q_vals
-
-        expected_q_vals_difference = torch.sum(
-            q_vals_difference, dim=0) / num_ens
-        sample_var = torch.sum((q_vals_difference - expected_q_vals_difference)
-                               ** 2, dim=0) / (num_ens - 1)
-        n2s_ratio = sample_var / (expected_q_vals_difference ** 2 + 1e-6)
-        n2s[i: i + batch_len] = torch.sum(n2s_ratio, dim=1).to('cpu')
-    return n2s
+    return ens_uncertainty(policy_net, states, metrics=('n2s_action_gap',), tau=tau,
+                           batch_size=batch_size, device=device)['n2s_action_gap']
 
 
 def ens_random(policy_net, states, tau=0.1, batch_size=128, device='cuda'):
@@ -69,10 +69,10 @@ class DirichletActionSelector(object):
             with torch.no_grad():
                 if training:
                     alpha = self.distn.sample()
-                    q_val = 0
-                    for i in range(self._policy_net.get_num_ensembles()):
-                        q_val += alpha[i] * \
-                            self._policy_net(state.to(self._device), ens_num=i)
+                    q_vals = self._policy_net.ensemble_q_values(
+                        state.to(self._device))
+                    q_val = torch.sum(
+                        alpha.to(q_vals).view(-1, 1, 1) * q_vals, 0)
                     a = q_val.max(1)[1].cpu().view(1, 1)
                 else:
                     a = self._policy_net(state.to(self._device)).max(1)[
@@ -201,12 +201,8 @@ class ProbabilisticActionSelector(object):
         action_var = None
         if sample > self._eps:
             with torch.no_grad():
-                q_vals = torch.zeros((self._policy_net.get_num_ensembles(),
-                                      self._n_actions))
-                state = state.to(self._device)
-                for i in range(self._policy_net.get_num_ensembles()):
-                    q_vals[i, :] = self._policy_net(
-                        state, ens_num=i).to('cpu').squeeze(0)
+                q_vals = self._policy_net.ensemble_q_values(
+                    state.to(self._device)).to('cpu').squeeze(1)
                 action_mean = torch.mean(q_vals, 0)
                 action_var = torch.var(q_vals, 0)
                 top_idx = torch.argmax(action_mean)
@@ -245,12 +241,8 @@ class MeanActionSelector(object):
         action_mean = None
         if sample > self._eps:
             with torch.no_grad():
-                q_vals = torch.zeros((self._policy_net.get_num_ensembles(),
-                                      self._n_actions))
-                state = state.to(self._device)
-                for i in range(self._policy_net.get_num_ensembles()):
-                    q_vals[i, :] = self._policy_net(
-                        state, ens_num=i).to('cpu').squeeze(0)
+                q_vals = self._policy_net.ensemble_q_values(
+                    state.to(self._device)).to('cpu').squeeze(1)
                 action_mean = torch.mean(q_vals, 0)
                 a = action_mean.argmax().item()
         else:
@@ -280,12 +272,8 @@ class MaxVarianceActionSelector(object):
         action_mean = None
         if sample > self._eps:
             with torch.no_grad():
-                q_vals = torch.zeros((self._policy_net.get_num_ensembles(),
-                                      self._n_actions))
-                state = state.to(self._device)
-                for i in range(self._policy_net.get_num_ensembles()):
-                    q_vals[i, :] = self._policy_net(
-                        state, ens_num=i).to('cpu').squeeze(0)
+                q_vals = self._policy_net.ensemble_q_values(
+                    state.to(self._device)).to('cpu').squeeze(1)
                 action_var = torch.var(q_vals, 0)
                 a = action_var.argmax().item()
         else:
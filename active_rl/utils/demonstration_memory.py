@@ -1,32 +1,129 @@
+import gzip
+import json
+import os
 import pickle
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import torch
+from .selection import top_k_indices
+
+COLUMNS = ('states', 'actions', 'rewards', 'dones')
+
+
+def load_shard(file_name):
+    """Loads a recorded shard, gzipped or plain."""
+    with open(file_name, 'rb') as file:
+        compressed = file.read(2) == b'\x1f\x8b'
+    with (gzip.open if compressed else open)(file_name, 'rb') as file:
+        return pickle.load(file)
+
+
+def n_steps_rollout(rewards, dones, gamma, n):
+    """Discounted n-step rewards and offsets of every transition.
+
+    The window of transition i stops after the first done or at the end of
+    the shard. Each of the n steps is one masked update over all
+    transitions.
+    """
+    num_rewards = rewards.shape[0]
+    rewards = rewards[:, 0].float()
+    dones = dones[:, 0].bool()
+    rewards_rollout = rewards.clone()
+    offset_rollout = torch.zeros(num_rewards)
+    alive = torch.ones(num_rewards, dtype=torch.bool)
+    for j in range(1, min(n, num_rewards)):
+        # step j is taken when step j - 1 did not end the episode
+        alive[: num_rewards - j] &= ~dones[j - 1: num_rewards - 1]
+        alive[num_rewards - j:] = False
+        rewards_rollout[: num_rewards - j] += (gamma ** j) * \
+            rewards[j:] * alive[: num_rewards - j]
+        offset_rollout += alive
+    return rewards_rollout.unsqueeze(1), offset_rollout.unsqueeze(1)
+
+
+def shard_scores(memory, compute):
+    """Acquisition scores of a ranked shard, reused while the model is fixed.
+
+    Scores are kept on the memory together with ``memory.model_version``;
+    with ``memory.score_sidecar`` they are also saved next to the shard as
+    ``<shard>.scores-<rank_func>-<score_tag>-<version>.pt``. The version is
+    only a counter, so ``memory.score_tag`` must name the run (or the
+    ranking network's weights) for the sidecars to be written or read.
+    Sidecars are never deleted; remove stale ``.scores-*`` files by hand. A
+    memory without a model version is rescored on every call, and a sidecar
+    older than its shard is ignored.
+    """
+    version = memory.model_version
+    if version is None:
+        return compute()
+    if memory.scores_version == version:
+        return memory.scores
+    if memory.score_sidecar and memory.score_tag is None:
+        raise ValueError('score_sidecar needs a score_tag identifying the '
+                         'run or ranking network')
+    rank_name = _rank_func_name(memory.rank_func)
+    sidecar = f'{memory.file_name}.scores-{rank_name}-{memory.score_tag}' \
+        f'-{version}.pt'
+    if memory.score_sidecar and _sidecar_is_fresh(sidecar, memory.file_name):
+        scores = torch.load(sidecar)
+    else:
+        scores = compute()
+        if memory.score_sidecar:
+            try:
+                torch.save(scores, sidecar)
+            except OSError:
+                pass
+    memory.scores = scores
+    memory.scores_version = version
+    return scores
+
+
+def _rank_func_name(rank_func):
+    name = getattr(rank_func, '__qualname__', type(rank_func).__name__)
+    return re.sub(r'[^0-9A-Za-z_.]', '_', name)
+
+
+def _sidecar_is_fresh(sidecar, file_name):
+    """Whether ``sidecar`` exists and was written after its shard.
+
+    Recording again into a directory rewrites ``0.pkl``, ``1.pkl``, ... so
+    a sidecar left over from an earlier recording must not be trusted.
+    """
+    if not os.path.exists(sidecar):
+        return False
+    return os.stat(sidecar).st_mtime_ns >= os.stat(file_name).st_mtime_ns
+
+
+def load_rollout(file_name, rewards, dones, gamma, n):
+    """``n_steps_rollout`` of a shard, cached in a sidecar file next to it."""
+    sidecar = f'{file_name}.rollout-{gamma}-{n}.pt'
+    if _sidecar_is_fresh(sidecar, file_name):
+        return torch.load(sidecar)
+    rollout = n_steps_rollout(rewards, dones, gamma, n)
+    try:
+        torch.save(rollout, sidecar)
+    except OSError:
+        # read-only datasets just recompute the rollout on every load
+        pass
+    return rollout
 
 
 class RolloutOfflineReplayMemory(object):
     def __init__(self, file_name, gamma, rollout_length):
-        with open(file_name, "rb") as file:
-            contents = pickle.load(file)
-            self.m_states = contents['states']
-            self.m_actions = contents['actions']
-            self.m_rewards = contents['rewards']
-            self.m_dones = contents['dones']
-            self.m_rewards_rollout, self.m_offset_rollout = self.n_steps_rollout(
-                self.m_rewards, self.m_dones, gamma, rollout_length)
+        contents = load_shard(file_name)
+        self.m_states = contents['states']
+        self.m_actions = contents['actions']
+        self.m_rewards = contents['rewards']
+        self.m_dones = contents['dones']
+        self.m_rewards_rollout, self.m_offset_rollout = load_rollout(
+            file_name, self.m_rewards, self.m_dones, gamma, rollout_length)
         self.position = 0
         self.size = self.m_states.shape[0]
 
     def n_steps_rollout(self, rewards, dones, gamma, n):
-        num_rewards = rewards.shape[0]
-        rewards_rollout = torch.zeros((num_rewards, 1))
-        offset_rollout = torch.zeros((num_rewards, 1))
-        for i in range(num_rewards):
-            j = 0
-            rewards_rollout[i, 0] = rewards[i + j, 0]
-            while j + 1 < n and i + j + 1 < num_rewards and not dones[i + j, 0]:
-                j += 1
-                rewards_rollout[i, 0] += (gamma ** j) * rewards[i + j, 0]
-            offset_rollout[i, 0] = j
-        return rewards_rollout, offset_rollout
+        return n_steps_rollout(rewards, dones, gamma, n)
 
     def sample(self, batch_size):
         i = torch.randint(0, high=self.size, size=(batch_size,))
@@ -48,36 +145,32 @@ class RolloutOfflineReplayMemory(object):
 
 
 class GenericRankedRolloutOfflineReplayMemory(object):
-    def __init__(self, file_name, gamma, rollout_length, rank_func):
-        with open(file_name, "rb") as file:
-            contents = pickle.load(file)
-            self.m_states = contents['states']
-            self.m_actions = contents['actions']
-            self.m_rewards = contents['rewards']
-            self.m_dones = contents['dones']
-            self.m_rewards_rollout, self.m_offset_rollout = self.n_steps_rollout(
-                self.m_rewards, self.m_dones, gamma, rollout_length)
+    def __init__(self, file_name, gamma, rollout_length, rank_func,
+                 model_version=None, score_sidecar=False, score_tag=None):
+        contents = load_shard(file_name)
+        self.m_states = contents['states']
+        self.m_actions = contents['actions']
+        self.m_rewards = contents['rewards']
+        self.m_dones = contents['dones']
+        self.m_rewards_rollout, self.m_offset_rollout = load_rollout(
+            file_name, self.m_rewards, self.m_dones, gamma, rollout_length)
         self.rank_func = rank_func
+        self.file_name = file_name
+        self.model_version = model_version
+        self.score_sidecar = score_sidecar
+        self.score_tag = score_tag
+        self.scores = None
+        self.scores_version = None
         self.position = 0
         self.size = self.m_states.shape[0]
 
     def n_steps_rollout(self, rewards, dones, gamma, n):
-        num_rewards = rewards.shape[0]
-        rewards_rollout = torch.zeros((num_rewards, 1))
-        offset_rollout = torch.zeros((num_rewards, 1))
-        for i in range(num_rewards):
-            j = 0
-            rewards_rollout[i, 0] = rewards[i + j, 0]
-            while j + 1 < n and i + j + 1 < num_rewards and not dones[i + j, 0]:
-                j += 1
-                rewards_rollout[i, 0] += (gamma ** j) * rewards[i + j, 0]
-            offset_rollout[i, 0] = j
-        return rewards_rollout, offset_rollout
+        return n_steps_rollout(rewards, dones, gamma, n)
 
     def sample(self, batch_size):
-        _, i = torch.sort(self.rank_func(self.m_states[: self.size, :4]),
-                          descending=True)
-        i = i[: batch_size]
+        i = top_k_indices(shard_scores(
+            self, lambda: self.rank_func(self.m_states[: self.size, :4])),
+            batch_size)
         states = self.m_states[i, :4]
         next_states = self.m_states[i, 1:]
         actions = self.m_actions[i]
@@ -96,40 +189,37 @@ class GenericRankedRolloutOfflineReplayMemory(object):
 
 
 class GenericRankedDoubleStatesRolloutOfflineReplayMemory(object):
-    def __init__(self, file_name, gamma, rollout_length, rank_func):
-        with open(file_name, "rb") as file:
-            contents = pickle.load(file)
-            self.m_states = contents['states']
-            self.m_actions = contents['actions']
-            self.m_rewards = contents['rewards']
-            self.m_dones = contents['dones']
-            self.m_rewards_rollout, self.m_offset_rollout = self.n_steps_rollout(
-                self.m_rewards, self.m_dones, gamma, rollout_length)
+    def __init__(self, file_name, gamma, rollout_length, rank_func,
+                 model_version=None, score_sidecar=False, score_tag=None):
+        contents = load_shard(file_name)
+        self.m_states = contents['states']
+        self.m_actions = contents['actions']
+        self.m_rewards = contents['rewards']
+        self.m_dones = contents['dones']
+        self.m_rewards_rollout, self.m_offset_rollout = load_rollout(
+            file_name, self.m_rewards, self.m_dones, gamma, rollout_length)
         self.rank_func = rank_func
+        self.file_name = file_name
+        self.model_version = model_version
+        self.score_sidecar = score_sidecar
+        self.score_tag = score_tag
+        self.scores = None
+        self.scores_version = None
         self.position = 0
         self.size = self.m_states.shape[0]
 
     def n_steps_rollout(self, rewards, dones, gamma, n):
-        num_rewards = rewards.shape[0]
-        rewards_rollout = torch.zeros((num_rewards, 1))
-        offset_rollout = torch.zeros((num_rewards, 1))
-        for i in range(num_rewards):
-            j = 0
-            rewards_rollout[i, 0] = rewards[i + j, 0]
-            while j + 1 < n and i + j + 1 < num_rewards and not dones[i + j, 0]:
-                j += 1
-                rewards_rollout[i, 0] += (gamma ** j) * rewards[i + j, 0]
-            offset_rollout[i, 0] = j
-        return rewards_rollout, offset_rollout
+        return n_steps_rollout(rewards, dones, gamma, n)
 
-    def sample(self, batch_size):
+    def rollout_scores(self):
         current_states = self.m_states[: self.size, :4]
         current_rollout_offsets = self.m_offset_rollout.squeeze().long()
         current_rollout_states = self.m_states[torch.arange(
             self.size) + current_rollout_offsets, 1:]
-        _, i = torch.sort(self.rank_func(
-            current_states, current_rollout_states), descending=True)
-        i = i[: batch_size]
+        return self.rank_func(current_states, current_rollout_states)
+
+    def sample(self, batch_size):
+        i = top_k_indices(shard_scores(self, self.rollout_scores), batch_size)
         states = self.m_states[i, :4]
         next_states = self.m_states[i, 1:]
         actions = self.m_actions[i]
@@ -145,3 +235,163 @@ class GenericRankedDoubleStatesRolloutOfflineReplayMemory(object):
 
     def __len__(self):
         return self.size
+
+
+def convert_to_columnar(shard_files, directory):
+    """Appends recorded shards to the raw column files of ``directory``.
+
+    Each field goes to its own ``<field>.bin`` file and ``index.json``
+    records dtypes, shapes and where every shard starts, so the dataset can
+    be memory-mapped by ``ColumnarDemonstrationMemory``. When ``directory``
+    already holds a dataset the shards are appended to it, and they must
+    match its dtypes and shapes. One shard is held in memory at a time.
+    """
+    os.makedirs(directory, exist_ok=True)
+    index_file = os.path.join(directory, 'index.json')
+    if os.path.exists(index_file):
+        with open(index_file) as file:
+            index = json.load(file)
+    else:
+        index = {'num_transitions': 0, 'columns': {}, 'shards': []}
+    files = {column: open(os.path.join(directory, f'{column}.bin'), 'ab')
+             for column in COLUMNS}
+    try:
+        for shard_file in shard_files:
+            contents = load_shard(shard_file)
+            size = contents['states'].shape[0]
+            for column in COLUMNS:
+                array = contents[column].numpy()
+                layout = {'dtype': array.dtype.str,
+                          'shape': list(array.shape[1:])}
+                if index['columns'].setdefault(column, layout) != layout:
+                    raise ValueError(
+                        f'{shard_file}: {column} is {layout}, the dataset '
+                        f'in {directory} has {index["columns"][column]}')
+            for column in COLUMNS:
+                np.ascontiguousarray(contents[column].numpy()).tofile(
+                    files[column])
+            index['shards'].append({'file': os.path.basename(shard_file),
+                                    'start': index['num_transitions'],
+                                    'size': size})
+            index['num_transitions'] += size
+    finally:
+        for file in files.values():
+            file.close()
+        # the index covers exactly the shards whose columns were written
+        with open(index_file, 'w') as file:
+            json.dump(index, file)
+    return index
+
+
+def rollout_window(rewards, dones, indices, ends, gamma, n):
+    """n-step discounted rewards and offsets for ``indices`` only.
+
+    Matches ``n_steps_rollout``: the window stops after the first done or at
+    ``ends`` (one past the last transition of each index's shard).
+    """
+    steps = torch.arange(n)
+    positions = indices.unsqueeze(1) + steps
+    inside = positions < ends.unsqueeze(1)
+    positions = torch.min(positions, ends.unsqueeze(1) - 1)
+    window_rewards = torch.as_tensor(rewards[positions.numpy()]).float()
+    window_dones = torch.as_tensor(dones[positions.numpy()]).bool()
+    window_rewards = window_rewards.reshape(positions.shape)
+    window_dones = window_dones.reshape(positions.shape)
+    # step j counts while every earlier step of the window is not done
+    alive = torch.cumprod(torch.cat((
+        torch.ones((indices.shape[0], 1)),
+        (~window_dones[:, :-1]).float()), dim=1), dim=1)
+    included = alive * inside.float()
+    rollout_rewards = (included * gamma ** steps.float()
+                       * window_rewards).sum(1, keepdim=True)
+    rollout_offsets = included.sum(1, keepdim=True) - 1
+    return rollout_rewards, rollout_offsets
+
+
+class ColumnarDemonstrationMemory(object):
+    """Samples demonstrations straight from memory-mapped column files.
+
+    Opening only reads ``index.json``, and a batch may mix transitions from
+    every shard. n-step returns are computed for the sampled transitions,
+    so ``sample`` returns the same tuple as ``RolloutOfflineReplayMemory``.
+    """
+
+    def __init__(self, directory, gamma, rollout_length):
+        with open(os.path.join(directory, 'index.json')) as file:
+            self.index = json.load(file)
+        self.gamma = gamma
+        self.rollout_length = rollout_length
+        self.size = self.index['num_transitions']
+        self.position = 0
+        columns = {}
+        for column in COLUMNS:
+            spec = self.index['columns'][column]
+            columns[column] = np.memmap(
+                os.path.join(directory, f'{column}.bin'),
+                dtype=np.dtype(spec['dtype']), mode='r',
+                shape=(self.size,) + tuple(spec['shape']))
+        self.m_states = columns['states']
+        self.m_actions = columns['actions']
+        self.m_rewards = columns['rewards']
+        self.m_dones = columns['dones']
+        self.shard_starts = torch.tensor(
+            [shard['start'] for shard in self.index['shards']])
+        self.shard_ends = torch.tensor(
+            [shard['start'] + shard['size'] for shard in self.index['shards']])
+
+    def _gather(self, column, indices):
+        return torch.from_numpy(column[indices.numpy()])
+
+    def sample(self, batch_size):
+        i = torch.randint(0, high=self.size, size=(batch_size,))
+        shards = torch.searchsorted(self.shard_starts, i, right=True) - 1
+        rollout_rewards, rollout_offsets = rollout_window(
+            self.m_rewards, self.m_dones, i, self.shard_ends[shards],
+            self.gamma, self.rollout_length)
+        stacks = self._gather(self.m_states, i)
+        states = stacks[:, :4]
+        next_states = stacks[:, 1:]
+        actions = self._gather(self.m_actions, i)
+        rewards = self._gather(self.m_rewards, i).float()
+        dones = self._gather(self.m_dones, i).float()
+        rollout_i = i + rollout_offsets.squeeze(1).long()
+        rollout_next_states = self._gather(self.m_states, rollout_i)[:, 1:]
+        rollout_dones = self._gather(self.m_dones, rollout_i).float()
+        return states, actions, rewards, next_states, dones, rollout_rewards, rollout_offsets, rollout_next_states, rollout_dones
+
+    def __len__(self):
+        return self.size
+
+
+class ShardCache(object):
+    """Bounded LRU of demonstration shards loaded in a background thread.
+
+    ``get(key, load)`` returns ``load()``'s result for ``key``, reusing a
+    cached or already prefetched shard when there is one. ``prefetch`` starts
+    loading a shard the caller will need next; its key is kept in
+    ``next_key`` for callers that pick shards at random.
+    """
+
+    def __init__(self, capacity=4, num_workers=1):
+        self.capacity = capacity
+        self.shards = OrderedDict()
+        self.executor = ThreadPoolExecutor(num_workers)
+        self.next_key = None
+
+    def get(self, key, load):
+        if key not in self.shards:
+            self.prefetch(key, load)
+        self.shards.move_to_end(key)
+        return self.shards[key].result()
+
+    def prefetch(self, key, load):
+        self.next_key = key
+        if key in self.shards:
+            self.shards.move_to_end(key)
+            return
+        self.shards[key] = self.executor.submit(load)
+        while len(self.shards) > self.capacity:
+            self.shards.popitem(last=False)
+
+    def __len__(self):
+        return len(self.shards)
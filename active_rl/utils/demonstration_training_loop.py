@@ -1,5 +1,5 @@
 from tqdm.notebook import tqdm
-from active_rl.utils.demonstration_memory import RolloutOfflineReplayMemory, GenericRankedRolloutOfflineReplayMemory
+from active_rl.utils.demonstration_memory import RolloutOfflineReplayMemory, GenericRankedRolloutOfflineReplayMemory, ShardCache
 from active_rl.utils.optimization import standard_optimization_ensemble
 from active_rl.utils.demonstration_optimization import standard_optimization, demo_optimization_ens_epochs
 from active_rl.utils.atari_utils import evaluate
@@ -8,6 +8,7 @@ from collections import deque
 from active_rl.utils.atari_utils import fp, ActionSelector
 import torch
 from active_rl.utils.memory import ReplayMemory
+from active_rl.utils.prefetch import PrefetchMemory
 
 
 standard_config = {
@@ -32,7 +33,14 @@ standard_config = {
     'rank_func': None,
     'epochs': 40,
     'demo_epoch_training_func': demo_optimization_ens_epochs,
-    'memory_class': GenericRankedRolloutOfflineReplayMemory
+    'memory_class': GenericRankedRolloutOfflineReplayMemory,
+    # a ShardCache shared between calls of the active demonstration loop
+    'shard_cache': None,
+    # version of the ranking network; shard scores are reused while it holds
+    'model_version': None,
+    'score_sidecar': False,
+    # names the run or ranking network in score sidecar file names
+    'score_tag': None
 }
 
 std_demo_config = {
@@ -40,6 +48,9 @@ std_demo_config = {
     'env': None,
     'env_raw': None,
     'memory_capacity': 400000,
+    'frame_dedup': False,
+    'compress': False,
+    'prefetch_batches': 0,
     'device': None,
     'eps_start': 1.0,
     'eps_end': 0.05,
@@ -78,10 +89,17 @@ def standard_training_loop(config):
     env_raw = config['env_raw']
     n_actions = config['n_actions']
     num_episodes = config['num_episodes']
+
+    def load(memory_id):
+        return lambda: RolloutOfflineReplayMemory(
+            config['file_name'] + f'/{memory_id}.pkl', config['gamma'], config['rollout_length'])
+    shard_cache = ShardCache(capacity=2)
     step = 0
     for memory_id in progressive:
-        memory = RolloutOfflineReplayMemory(
-            config['file_name'] + f'/{memory_id}.pkl', config['gamma'], config['rollout_length'])
+        memory = shard_cache.get(memory_id, load(memory_id))
+        if memory_id + 1 < num_memory:
+            # the next shard loads while this one is trained on
+            shard_cache.prefetch(memory_id + 1, load(memory_id + 1))
         progressive_training_steps = tqdm(range(
             num_steps_per_memory), total=num_steps_per_memory, ncols=400, leave=False, unit='b')
         for training_step in progressive_training_steps:
@@ -110,9 +128,23 @@ def active_demonstration_training_single_loop(config):
     epochs = config['epochs']
     demo_epoch_training_func = config['demo_epoch_training_func']
     memory_class = config['memory_class']
-    memory_id = random.randint(0, num_memory - 1)
-    memory = memory_class(
-        config['file_name'] + f'/{memory_id}.pkl', config['gamma'], config['rollout_length'], config['rank_func'])
+    shard_cache = config.get('shard_cache')
+
+    def load(memory_id):
+        return lambda: memory_class(
+            config['file_name'] + f'/{memory_id}.pkl', config['gamma'], config['rollout_length'], config['rank_func'])
+    if shard_cache is None:
+        memory = load(random.randint(0, num_memory - 1))()
+    else:
+        memory_id = shard_cache.next_key
+        if memory_id is None:
+            memory_id = random.randint(0, num_memory - 1)
+        memory = shard_cache.get(memory_id, load(memory_id))
+        next_id = random.randint(0, num_memory - 1)
+        shard_cache.prefetch(next_id, load(next_id))
+    memory.model_version = config.get('model_version')
+    memory.score_sidecar = config.get('score_sidecar', False)
+    memory.score_tag = config.get('score_tag')
     return demo_epoch_training_func(policy_net, target_net, memory, optimizer, gamma, lambda1, lambda2, batch_size, epochs, device)
 
 
@@ -137,9 +169,15 @@ def active_demo_std_training(config):
     demo_config = config['demo_config']
     memory_capacity = config['memory_capacity']
     std_training_func = config['std_training_func']
+    frame_dedup = config.get('frame_dedup', False)
+    compress = config.get('compress', False)
+    prefetch_batches = config.get('prefetch_batches', 0)
     n_actions = env.action_space.n
     c, h, w = fp(env.reset()).shape
-    memory = ReplayMemory(memory_capacity, [5, h, w], n_actions, device)
+    memory = ReplayMemory(memory_capacity, [5, h, w], n_actions, device,
+                          frame_dedup=frame_dedup, compress=compress)
+    if prefetch_batches > 0:
+        memory = PrefetchMemory(memory, batch_size, prefetch_batches, device)
     action_selector = ActionSelector(
         eps_start, eps_end, policy_net, eps_decay, n_actions, device)
     progressive = tqdm(
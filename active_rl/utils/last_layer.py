@@ -0,0 +1,91 @@
+import torch
+
+
+class LastLayerLaplace(object):
+    """Gaussian posterior over the ``fc2`` weights of a single DQN.
+
+    ``fit`` runs the trunk over the labelled states once and accumulates the
+    Gram matrix of their penultimate features. With a Gaussian likelihood
+    around the trained weights, the posterior of each action's row of
+    ``fc2`` (bias included) has mean equal to the trained row and covariance
+    ``(prior_precision * I + features^T features / noise_variance)^-1``.
+
+    ``num_samples`` heads are drawn once per fit and reused for every
+    state, so the sampler behaves like an ensemble: it implements
+    ``get_num_ensembles`` and ``ensemble_q_values`` and can be passed to the
+    ``ens_*`` acquisition functions and the EnsDQN BALD memories. Each call
+    computes the trunk once and every head is a single matmul.
+    """
+
+    def __init__(self, net, num_samples=100, prior_precision=1.0,
+                 noise_variance=1.0, device='cuda'):
+        self.net = net
+        self.num_samples = num_samples
+        self.prior_precision = prior_precision
+        self.noise_variance = noise_variance
+        self.device = device
+        self.weight = None
+        self.scale_tril = None
+        self.head_noise = None
+
+    def fit(self, memory, batch_size=128):
+        """Fits the posterior to the states of ``memory`` (a replay memory)."""
+        gram = None
+        for _, states in memory.iter_candidates(batch_size):
+            with torch.no_grad():
+                features = self._features(states[:, :4].to(self.device))
+            features = _with_bias(features).double()
+            if gram is None:
+                gram = features.t() @ features
+            else:
+                gram += features.t() @ features
+        fc2 = self.net.fc2
+        num_features = fc2.in_features + 1
+        precision = self.prior_precision * torch.eye(
+            num_features, dtype=torch.double, device=fc2.weight.device)
+        if gram is not None:
+            precision += gram.to(precision.device) / self.noise_variance
+        # cholesky of the covariance from that of the flipped precision
+        flip = torch.flip(precision, (0, 1))
+        scale_tril = torch.linalg.inv(torch.linalg.cholesky(flip))
+        self.scale_tril = torch.flip(scale_tril, (0, 1)).t().float()
+        self.weight = torch.cat((fc2.weight, fc2.bias.unsqueeze(1)),
+                                dim=1).detach().clone()
+        self.resample()
+        return self
+
+    def resample(self):
+        """Draws a new set of ``num_samples`` heads."""
+        self.head_noise = torch.randn(
+            (self.num_samples, self.weight.shape[0], self.weight.shape[1]),
+            device=self.weight.device)
+
+    def get_num_ensembles(self):
+        return self.num_samples
+
+    def ensemble_q_values(self, x):
+        """Q-values of every sampled head as (samples, batch, actions)."""
+        return self.q_values_from_features(self._features(x))
+
+    def q_values_from_features(self, features):
+        """``ensemble_q_values`` for precomputed penultimate features."""
+        features = _with_bias(features.to(self.weight.device))
+        mean = features @ self.weight.t()
+        deviation = torch.einsum('bd,sad->sba', features @ self.scale_tril,
+                                 self.head_noise)
+        return mean.unsqueeze(0) + deviation
+
+    def __call__(self, x, ens_num=None):
+        if ens_num is None:
+            return self.net(x)
+        return self.ensemble_q_values(x)[ens_num]
+
+    def _features(self, x):
+        _, features = self.net(x, last_layer=True)
+        return features
+
+
+def _with_bias(features):
+    features = features.float()
+    return torch.cat((features, features.new_ones((features.shape[0], 1))),
+                     dim=1)
@@ -2,57 +2,229 @@ import torch
 from batchbald_redux.batchbald import get_batchbald_batch, get_bald_batch
 import random
 import pickle
-
-
-class ReplayMemory(object):
-    def __init__(self, capacity, state_shape, n_actions, device):
-        c, h, w = state_shape
-        self.capacity = capacity
-        self.device = device
-        self.m_states = torch.zeros((capacity, c, h, w), dtype=torch.uint8)
-        self.m_actions = torch.zeros((capacity, 1), dtype=torch.long)
-        self.m_rewards = torch.zeros((capacity, 1), dtype=torch.int8)
-        self.m_dones = torch.zeros((capacity, 1), dtype=torch.bool)
-        self.position = 0
-        self.size = 0
+import gzip
+import queue
+import threading
+from .demonstration_memory import n_steps_rollout
+from .selection import top_k_indices
+from .storage import BaseReplayMemory
+
+
+def _buffer_file_name(file_name, buffer_name):
+    if file_name is None:
+        return None
+    return f'{file_name}_{buffer_name}'
+
+
+def _enable_mc_feature_cache(buffer, net, max_age):
+    # only the dropout and fc2 are sampled, so the trunk's features are kept
+    # per slot until bump_trunk_version
+    buffer.enable_feature_cache(net.fc2.in_features, max_age)
+
+
+def _mc_pool_q_values(net, buffer, num_samples, n_actions, batch_size,
+                      device):
+    """MC-dropout Q-values of every slot of ``buffer`` as (N, samples, A).
+
+    With a feature cache on ``buffer`` only the dropout and ``fc2`` are
+    evaluated; the trunk runs on the stale slots alone, ``batch_size`` at a
+    time.
+    """
+    def features(states):
+        with torch.no_grad():
+            _, x = net(states[:, :4].to(device), last_layer=True)
+        return x
+
+    num_states = len(buffer)
+    out = torch.empty((num_states, num_samples, n_actions))
+    if buffer.feature_cache is not None:
+        cached = buffer.cached_features(features, chunk_size=batch_size)
+        for j in range(0, num_states, batch_size):
+            next_features = cached[j:j + batch_size].to(device)
+            with torch.no_grad():
+                out[j:j + next_features.shape[0]] = \
+                    net.mc_q_values_from_features(
+                        next_features, num_samples).transpose(0, 1)
+    else:
+        for j, states in buffer.iter_candidates(batch_size):
+            next_states = states[:, :4].to(device)
+            with torch.no_grad():
+                out[j:j + next_states.shape[0]] = net.mc_q_values(
+                    next_states, num_samples).transpose(0, 1)
+    return out
+
+
+def _enable_ens_score_cache(buffer, net, n_actions, max_age):
+    # the cached scores are the members' Q-values of every slot
+    buffer.enable_score_cache((net.get_num_ensembles(), n_actions), max_age)
+
+
+def _ens_q_values(net, states, n_actions, batch_size, device):
+    """Q-values of every ensemble member as (N, members, A)."""
+    num_states = states.shape[0]
+    out = torch.empty((num_states, net.get_num_ensembles(), n_actions))
+    for j in range(0, num_states, batch_size):
+        next_states = states[j:j + batch_size, :4].to(device)
+        with torch.no_grad():
+            out[j:j + next_states.shape[0]] = net.ensemble_q_values(
+                next_states).transpose(0, 1).cpu()
+    return out
+
+
+class ReplayMemory(BaseReplayMemory):
+    def __init__(self, capacity, state_shape, n_actions, device,
+                 frame_dedup=False, compress=False, file_name=None,
+                 reuse_buffers=False, n_steps=None, gamma=0.99):
+        super(ReplayMemory, self).__init__(
+            capacity, state_shape, n_actions, device, frame_dedup=frame_dedup,
+            compress=compress, file_name=file_name)
+        self.reuse_buffers = reuse_buffers
+        self.batch_buffers = None
+        self.n_steps = n_steps
+        if n_steps is not None:
+            # same layout as the offline demonstration memories
+            self.m_rewards_rollout = torch.zeros((capacity, 1))
+            self.m_offset_rollout = torch.zeros((capacity, 1))
+            self.gamma = gamma
+            self.discounts = gamma ** torch.arange(1, n_steps).float()
+            self.open_windows = 0
 
     def push(self, state, action, reward, done):
-        """Saves a transition."""
-        self.m_states[self.position] = state  # 5,84,84
-        self.m_actions[self.position, 0] = action
-        self.m_rewards[self.position, 0] = reward
-        self.m_dones[self.position, 0] = done
-        self.position = (self.position + 1) % self.capacity
-        self.size = max(self.size, self.position)
-
-    def sample(self, batch_size=None):
+        super(ReplayMemory, self).push(state, action, reward, done)
+        if self.n_steps is not None:
+            self._extend_rollouts(1)
+
+    def push_batch(self, states, actions, rewards, dones):
+        super(ReplayMemory, self).push_batch(states, actions, rewards, dones)
+        if self.n_steps is not None:
+            self._extend_rollouts(min(states.shape[0], self.capacity))
+
+    def push_from(self, memory, indices):
+        super(ReplayMemory, self).push_from(memory, indices)
+        if self.n_steps is not None:
+            # gathered rows are not consecutive, so they keep 1-step returns
+            num_transitions = min(len(indices), self.capacity)
+            slots = (self.position - torch.arange(1, num_transitions + 1)) \
+                % self.capacity
+            self.m_rewards_rollout[slots] = self.m_rewards[slots]
+            self.m_offset_rollout[slots] = 0
+            self.open_windows = 0
+
+    def _extend_rollouts(self, num_transitions):
+        """Adds the newest transitions to the n-step windows still open.
+
+        The windows of the new block are computed with ``n_steps_rollout``;
+        the up to n - 1 earlier windows that have not met a done are then
+        extended over the head of the block in one masked update.
+        """
+        slots = (self.position - num_transitions +
+                 torch.arange(num_transitions)) % self.capacity
+        rewards = self.m_rewards[slots]
+        dones = self.m_dones[slots, 0].bool()
+        self.m_rewards_rollout[slots], self.m_offset_rollout[slots] = \
+            n_steps_rollout(rewards, self.m_dones[slots], self.gamma,
+                            self.n_steps)
+        open_windows = min(self.open_windows,
+                           self.capacity - num_transitions)
+        if open_windows > 0:
+            # window s slots back has taken s - 1 steps; step s + k adds
+            # block transition k unless an earlier one in the block was done
+            head = min(self.n_steps - 1, num_transitions)
+            distance = torch.arange(1, open_windows + 1).unsqueeze(1)
+            k = torch.arange(head).unsqueeze(0)
+            alive = torch.ones(head, dtype=torch.bool)
+            alive[1:] = ~dones[: head - 1]
+            alive = torch.cumprod(alive, 0).bool()
+            taken = alive & (distance + k <= self.n_steps - 1)
+            steps = (distance + k).clamp(max=self.n_steps - 1)
+            added = taken * self.discounts[steps - 1] * rewards[:head, 0]
+            earlier = (slots[0] - distance[:, 0]) % self.capacity
+            self.m_rewards_rollout[earlier, 0] += added.sum(1)
+            self.m_offset_rollout[earlier, 0] += taken.sum(1).float()
+        done_at = dones.nonzero().flatten()
+        if done_at.shape[0] > 0:
+            self.open_windows = min(
+                num_transitions - 1 - int(done_at[-1]), self.n_steps - 1)
+        else:
+            self.open_windows = min(self.open_windows + num_transitions,
+                                    self.n_steps - 1)
+
+    def sample(self, batch_size=None, out=None):
+        """Samples a batch; ``bs`` and ``bns`` are views of one 5-frame gather.
+
+        ``out`` may hold ``(states, actions, rewards, dones)`` tensors to
+        gather into. With ``reuse_buffers`` the memory keeps its own, so the
+        returned batch is only valid until the next call. With ``n_steps``
+        the n-step rollout fields of ``RolloutOfflineReplayMemory.sample``
+        are appended.
+        """
         if batch_size is None or len(self) < batch_size:
             batch_size = len(self)
         i = torch.randint(0, high=self.size, size=(batch_size,))
-        bs = self.m_states[i, :4]
-        bns = self.m_states[i, 1:]
-        ba = self.m_actions[i]
-        br = self.m_rewards[i].float()
-        bd = self.m_dones[i].float()
-        return bs, ba, br, bns, bd
-
-    def __len__(self):
-        return self.size
+        if out is None and self.reuse_buffers:
+            out = self._batch_buffers(batch_size)
+        states, ba, br, bd = self.gather(i, out)
+        if self.n_steps is None:
+            return states[:, :4], ba, br, states[:, 1:], bd
+        rollout_rewards = self.m_rewards_rollout[i]
+        rollout_offsets = self.m_offset_rollout[i]
+        rollout_i = (i + rollout_offsets[:, 0].long()) % self.capacity
+        rollout_next_states = self.m_states[rollout_i, 1:]
+        rollout_dones = self.m_dones[rollout_i]
+        return (states[:, :4], ba, br, states[:, 1:], bd, rollout_rewards,
+                rollout_offsets, rollout_next_states, rollout_dones)
+
+    def _batch_buffers(self, batch_size):
+        if self.batch_buffers is None or \
+                self.batch_buffers[0].shape[0] != batch_size:
+            self.batch_buffers = tuple(
+                torch.empty((batch_size,) + tuple(field.shape[1:]),
+                            dtype=field.dtype)
+                for field in (self.m_states, self.m_actions, self.m_rewards,
+                              self.m_dones))
+        return self.batch_buffers
 
 
 class RecordReplayMemory(object):
-    def __init__(self, capacity, state_shape, n_actions, file_name, device):
-        c, h, w = state_shape
+    """Records transitions into pickled shards of ``capacity`` transitions.
+
+    With ``async_store`` a full buffer is handed to a background thread and
+    recording continues into one of ``num_buffers - 1`` spare buffers; a push
+    only waits when every spare is still being written. An error raised
+    while writing a shard in the background is re-raised by the next
+    ``store`` or ``flush``. ``compress`` gzips the shards, which
+    ``demonstration_memory.load_shard`` reads back.
+    """
+
+    def __init__(self, capacity, state_shape, n_actions, file_name, device,
+                 async_store=False, num_buffers=2, compress=False):
         self.capacity = capacity
+        self.state_shape = state_shape
         self.device = device
-        self.m_states = torch.zeros((capacity, c, h, w), dtype=torch.uint8)
-        self.m_actions = torch.zeros((capacity, 1), dtype=torch.long)
-        self.m_rewards = torch.zeros((capacity, 1), dtype=torch.int8)
-        self.m_dones = torch.zeros((capacity, 1), dtype=torch.bool)
+        (self.m_states, self.m_actions, self.m_rewards,
+         self.m_dones) = self._allocate_buffers()
         self.file_name = file_name
         self.file_counter = 0
         self.position = 0
         self.size = 0
+        self.compress = compress
+        self.writer = None
+        self.write_error = None
+        if async_store:
+            self.pending = queue.Queue()
+            self.free_buffers = queue.Queue()
+            for _ in range(num_buffers - 1):
+                self.free_buffers.put(self._allocate_buffers())
+            self.writer = threading.Thread(target=self._write_shards,
+                                           daemon=True)
+            self.writer.start()
+
+    def _allocate_buffers(self):
+        c, h, w = self.state_shape
+        return (torch.zeros((self.capacity, c, h, w), dtype=torch.uint8),
+                torch.zeros((self.capacity, 1), dtype=torch.long),
+                torch.zeros((self.capacity, 1), dtype=torch.int8),
+                torch.zeros((self.capacity, 1), dtype=torch.bool))
 
     def push(self, state, action, reward, done):
         """Saves a transition."""
@@ -66,85 +238,100 @@ class RecordReplayMemory(object):
         self.size = max(self.size, self.position)
 
     def store(self):
-        file_name = f'{self.file_name}/{self.file_counter}.pkl'
-        file_content = {'states': self.m_states, 'actions': self.m_actions,
-                        'rewards': self.m_rewards, 'dones': self.m_dones}
-        with open(file_name, 'wb+') as file:
-            pickle.dump(file_content, file, pickle.HIGHEST_PROTOCOL)
+        buffers = (self.m_states, self.m_actions, self.m_rewards,
+                   self.m_dones)
+        if self.writer is None:
+            self._store(self.file_counter, buffers)
+        else:
+            self._raise_write_error()
+            self.pending.put((self.file_counter, buffers))
+            (self.m_states, self.m_actions, self.m_rewards,
+             self.m_dones) = self.free_buffers.get()
         self.file_counter += 1
 
+    def flush(self):
+        """Waits until every handed-off shard is on disk."""
+        if self.writer is not None:
+            self.pending.join()
+            self._raise_write_error()
+
+    def _raise_write_error(self):
+        if self.write_error is not None:
+            error, self.write_error = self.write_error, None
+            raise error
+
+    def _write_shards(self):
+        while True:
+            file_counter, buffers = self.pending.get()
+            try:
+                self._store(file_counter, buffers)
+            except Exception as error:
+                if self.write_error is None:
+                    self.write_error = error
+            finally:
+                self.free_buffers.put(buffers)
+                self.pending.task_done()
+
+    def _store(self, file_counter, buffers):
+        file_name = f'{self.file_name}/{file_counter}.pkl'
+        states, actions, rewards, dones = buffers
+        file_content = {'states': states, 'actions': actions,
+                        'rewards': rewards, 'dones': dones}
+        if self.compress:
+            file = gzip.open(file_name, 'wb', compresslevel=1)
+        else:
+            file = open(file_name, 'wb+')
+        with file:
+            pickle.dump(file_content, file, pickle.HIGHEST_PROTOCOL)
+
     def __len__(self):
         return self.size
 
 
-class _ReplayMemory(object):
-    def __init__(self, capacity, state_shape, n_actions, device):
-        c, h, w = state_shape
-        self.capacity = capacity
-        self.device = device
-        self.m_states = torch.zeros((capacity, c, h, w), dtype=torch.uint8)
-        self.m_actions = torch.zeros((capacity, 1), dtype=torch.long)
-        self.m_rewards = torch.zeros((capacity, 1), dtype=torch.int8)
-        self.m_dones = torch.zeros((capacity, 1), dtype=torch.bool)
-        self.position = 0
-        self.size = 0
-
-    def push(self, state, action, reward, done):
-        """Saves a transition."""
-        self.m_states[self.position] = state  # 5,84,84
-        self.m_actions[self.position, 0] = action
-        self.m_rewards[self.position, 0] = reward
-        self.m_dones[self.position, 0] = done
-        self.position = (self.position + 1) % self.capacity
-        self.size = max(self.size, self.position)
+class _ReplayMemory(BaseReplayMemory):
+    def __init__(self, capacity, state_shape, n_actions, device,
+                 frame_dedup=False, compress=False, file_name=None):
+        super(_ReplayMemory, self).__init__(
+            capacity, state_shape, n_actions, device, frame_dedup=frame_dedup,
+            compress=compress, file_name=file_name)
 
-    def sample(self, batch_size=None):
+    def sample_indices(self, batch_size=None):
         if batch_size is None or len(self) < batch_size:
             batch_size = len(self)
-        i = torch.randint(0, high=self.size, size=(batch_size,))
+        return torch.randint(0, high=self.size, size=(batch_size,))
+
+    def sample(self, batch_size=None):
+        i = self.sample_indices(batch_size)
         bs = self.m_states[i]
         ba = self.m_actions[i]
         br = self.m_rewards[i].float()
         bd = self.m_dones[i].float()
         return bs, ba, br, bd
 
-    def __len__(self):
-        return self.size
-
 
-class RankedReplayMemory(object):
+class RankedReplayMemory(BaseReplayMemory):
     def __init__(self, capacity, state_shape, n_actions, rank_func, AMN_net,
-                 replacement=False, device='cuda'):
-        c, h, w = state_shape
-        self.capacity = capacity
-        self.device = device
-        self.m_states = torch.zeros((capacity, c, h, w), dtype=torch.uint8)
-        self.m_actions = torch.zeros((capacity, 1), dtype=torch.long)
-        self.m_rewards = torch.zeros((capacity, 1), dtype=torch.int8)
-        self.m_dones = torch.zeros((capacity, 1), dtype=torch.bool)
-        self.position = 0
-        self.size = 0
+                 replacement=False, device='cuda', frame_dedup=False,
+                 compress=False, file_name=None, score_cache=False,
+                 score_max_age=None, per_state_scores=False):
+        super(RankedReplayMemory, self).__init__(
+            capacity, state_shape, n_actions, device, frame_dedup=frame_dedup,
+            compress=compress, file_name=file_name)
         self.rank_func = rank_func
         self.AMN_net = AMN_net
         self.replacement = replacement
-
-    def push(self, state, action, reward, done):
-        """Saves a transition."""
-        self.m_states[self.position] = state  # 5,84,84
-        self.m_actions[self.position, 0] = action
-        self.m_rewards[self.position, 0] = reward
-        self.m_dones[self.position, 0] = done
-        self.position = (self.position + 1) % self.capacity
-        self.size = max(self.size, self.position)
+        self.per_state_scores = per_state_scores
+        if score_cache:
+            self.enable_score_cache(max_age=score_max_age,
+                                    per_state=per_state_scores)
 
     def sample(self, percentage=0.1, batch_size=None):
-        _, i = torch.sort(self.rank_func(
-            self.AMN_net, self.m_states[: self.size, :4], device=self.device),
-            descending=True)
-        if batch_size is not None:
-            i = i[: batch_size]
-        else:
-            i = i[: int(percentage * self.size)]
+        if batch_size is None:
+            batch_size = int(percentage * self.size)
+        i = self.top_candidates(
+            lambda states: self.rank_func(
+                self.AMN_net, states[:, :4], device=self.device), batch_size,
+            per_state=self.per_state_scores)
         i = i[torch.randperm(i.shape[0])]
         # i = torch.randint(0, high=self.size, size=(bs,))
         bs = self.m_states[i, :4]
@@ -153,101 +340,67 @@ class RankedReplayMemory(object):
         br = self.m_rewards[i].float()
         bd = self.m_dones[i].float()
         if self.replacement:
-            read_index = 0
-            write_index = 0
-            i_set = set(i.flatten())
-            while read_index < self.size:
-                if read_index in i_set:
-                    read_index += 1
-                else:
-                    self.m_states[write_index] = self.m_states[read_index]
-                    self.m_actions[write_index,
-                                   0] = self.m_actions[read_index, 0]
-                    self.m_rewards[write_index,
-                                   0] = self.m_rewards[read_index, 0]
-                    self.m_dones[write_index, 0] = self.m_dones[read_index, 0]
-                    read_index += 1
-                    write_index += 1
-            self.size -= len(i_set)
-            self.position -= len(i_set)
-            self.position = self.position % self.size
+            self.remove(i)
         return bs, ba, br, bns, bd
 
-    def __len__(self):
-        return self.size
-
 
-class GenericRankedReplayMemory(object):
-    def __init__(self, capacity, state_shape, n_actions, rank_func):
-        c, h, w = state_shape
-        self.capacity = capacity
-        self.m_states = torch.zeros((capacity, c, h, w), dtype=torch.uint8)
-        self.m_actions = torch.zeros((capacity, 1), dtype=torch.long)
-        self.m_rewards = torch.zeros((capacity, 1), dtype=torch.int8)
-        self.m_dones = torch.zeros((capacity, 1), dtype=torch.bool)
-        self.position = 0
-        self.size = 0
+class GenericRankedReplayMemory(BaseReplayMemory):
+    def __init__(self, capacity, state_shape, n_actions, rank_func,
+                 frame_dedup=False, compress=False, file_name=None,
+                 score_cache=False, score_max_age=None,
+                 per_state_scores=False):
+        super(GenericRankedReplayMemory, self).__init__(
+            capacity, state_shape, n_actions, frame_dedup=frame_dedup,
+            compress=compress, file_name=file_name)
         self.rank_func = rank_func
+        self.per_state_scores = per_state_scores
+        if score_cache:
+            self.enable_score_cache(max_age=score_max_age,
+                                    per_state=per_state_scores)
 
-    def push(self, state, action, reward, done):
-        """Saves a transition."""
-        self.m_states[self.position] = state  # 5,84,84
-        self.m_actions[self.position, 0] = action
-        self.m_rewards[self.position, 0] = reward
-        self.m_dones[self.position, 0] = done
-        self.position = (self.position + 1) % self.capacity
-        self.size = max(self.size, self.position)
+    def label_percentage_indices(self, percentage):
+        i = self.top_candidates(lambda states: self.rank_func(states[:, :4]),
+                                int(percentage * self.size),
+                                per_state=self.per_state_scores)
+        return i[torch.randperm(i.shape[0])]
 
     def label_percentage(self, percentage):
-        _, i = torch.sort(self.rank_func(self.m_states[: self.size, :4]),
-                          descending=True)
-        i = i[: int(percentage * self.size)]
-        i = i[torch.randperm(i.shape[0])]
+        i = self.label_percentage_indices(percentage)
         bs = self.m_states[i]
         ba = self.m_actions[i]
         br = self.m_rewards[i].float()
         bd = self.m_dones[i].float()
         return bs, ba, br, bd
 
-    def __len__(self):
-        return self.size
 
-
-class GenericRankedDoubleStatesReplayMemory(object):
-    def __init__(self, capacity, state_shape, n_actions, rank_func):
-        c, h, w = state_shape
-        self.capacity = capacity
-        self.m_states = torch.zeros((capacity, c, h, w), dtype=torch.uint8)
-        self.m_actions = torch.zeros((capacity, 1), dtype=torch.long)
-        self.m_rewards = torch.zeros((capacity, 1), dtype=torch.int8)
-        self.m_dones = torch.zeros((capacity, 1), dtype=torch.bool)
-        self.position = 0
-        self.size = 0
+class GenericRankedDoubleStatesReplayMemory(BaseReplayMemory):
+    def __init__(self, capacity, state_shape, n_actions, rank_func,
+                 frame_dedup=False, compress=False, file_name=None,
+                 score_cache=False, score_max_age=None,
+                 per_state_scores=False):
+        super(GenericRankedDoubleStatesReplayMemory, self).__init__(
+            capacity, state_shape, n_actions, frame_dedup=frame_dedup,
+            compress=compress, file_name=file_name)
         self.rank_func = rank_func
+        self.per_state_scores = per_state_scores
+        if score_cache:
+            self.enable_score_cache(max_age=score_max_age,
+                                    per_state=per_state_scores)
 
-    def push(self, state, action, reward, done):
-        """Saves a transition."""
-        self.m_states[self.position] = state  # 5,84,84
-        self.m_actions[self.position, 0] = action
-        self.m_rewards[self.position, 0] = reward
-        self.m_dones[self.position, 0] = done
-        self.position = (self.position + 1) % self.capacity
-        self.size = max(self.size, self.position)
+    def label_percentage_indices(self, percentage):
+        i = self.top_candidates(
+            lambda states: self.rank_func(states[:, :4], states[:, :4]),
+            int(percentage * self.size), per_state=self.per_state_scores)
+        return i[torch.randperm(i.shape[0])]
 
     def label_percentage(self, percentage):
-        _, i = torch.sort(self.rank_func(self.m_states[: self.size, :4], self.m_states[: self.size, :4]),
-                          descending=True)
-        i = i[: int(percentage * self.size)]
-        i = i[torch.randperm(i.shape[0])]
+        i = self.label_percentage_indices(percentage)
         bs = self.m_states[i]
         ba = self.m_actions[i]
         br = self.m_rewards[i].float()
         bd = self.m_dones[i].float()
         return bs, ba, br, bd
 
-    def __len__(self):
-        return self.size
-
 
 class GenericLabelledReplayMemory():
     def __init__(self, rank_buffer, labelled_buffer):
@@ -259,10 +412,9 @@ class GenericLabelledReplayMemory():
         self.rank_buffer.push(state, action, reward, done)
 
     def label_sample_percentage(self, percentage):
-        bs, ba, br, bd = self.rank_buffer.label_percentage(percentage)
-        for i in range(bs.shape[0]):
-            self.labeled_buffer.push(bs[i], ba[i, 0], br[i, 0], bd[i, 0])
-        return bs.shape[0]
+        i = self.rank_buffer.label_percentage_indices(percentage)
+        self.labeled_buffer.push_from(self.rank_buffer, i)
+        return i.shape[0]
 
     def sample(self, batch_size):
         bs, ba, br, bns, bd = self.labeled_buffer.sample(batch_size=batch_size)
@@ -272,67 +424,68 @@ class GenericLabelledReplayMemory():
         return len(self.labeled_buffer)
 
 
-class _RankedReplayMemory(object):
+class _RankedReplayMemory(BaseReplayMemory):
     def __init__(self, capacity, state_shape, n_actions, rank_func, AMN_net,
-                 tau, device='cuda'):
-        c, h, w = state_shape
-        self.capacity = capacity
-        self.device = device
-        self.m_states = torch.zeros((capacity, c, h, w), dtype=torch.uint8)
-        self.m_actions = torch.zeros((capacity, 1), dtype=torch.long)
-        self.m_rewards = torch.zeros((capacity, 1), dtype=torch.int8)
-        self.m_dones = torch.zeros((capacity, 1), dtype=torch.bool)
-        self.position = 0
-        self.size = 0
+                 tau, device='cuda', frame_dedup=False, compress=False,
+                 file_name=None, score_cache=False, score_max_age=None,
+                 per_state_scores=False):
+        super(_RankedReplayMemory, self).__init__(
+            capacity, state_shape, n_actions, device, frame_dedup=frame_dedup,
+            compress=compress, file_name=file_name)
         self.rank_func = rank_func
         self.AMN_net = AMN_net
-
-    def push(self, state, action, reward, done):
-        """Saves a transition."""
-        self.m_states[self.position] = state  # 5,84,84
-        self.m_actions[self.position, 0] = action
-        self.m_rewards[self.position, 0] = reward
-        self.m_dones[self.position, 0] = done
-        self.position = (self.position + 1) % self.capacity
-        self.size = max(self.size, self.position)
+        self.per_state_scores = per_state_scores
+        if score_cache:
+            self.enable_score_cache(max_age=score_max_age,
+                                    per_state=per_state_scores)
+
+    def sample_indices(self, percentage=0.1, batch_size=64):
+        i = self.top_candidates(
+            lambda states: self.rank_func(
+                self.AMN_net, states[:, :4], batch_size=batch_size,
+                device=self.device), int(percentage * self.size),
+            per_state=self.per_state_scores)
+        return i[torch.randperm(i.shape[0])]
 
     def sample(self, percentage=0.1, batch_size=64):
-        _, i = torch.sort(self.rank_func(
-            self.AMN_net, self.m_states[: self.size, :4], batch_size=batch_size, device=self.device),
-            descending=True)
-        i = i[: int(percentage * self.size)]
-        i = i[torch.randperm(i.shape[0])]
-        # i = torch.randint(0, high=self.size, size=(bs,))
+        i = self.sample_indices(percentage=percentage, batch_size=batch_size)
         bs = self.m_states[i]
         ba = self.m_actions[i]
         br = self.m_rewards[i].float()
         bd = self.m_dones[i].float()
         return bs, ba, br, bd
 
-    def __len__(self):
-        return self.size
-
 
 class LabelledReplayMemory():
     def __init__(self, capacity_not_labelled, capacity_labelled, state_shape,
-                 n_actions, rank_func, AMN_net, tau=0.1, device='cuda'):
+                 n_actions, rank_func, AMN_net, tau=0.1, device='cuda',
+                 frame_dedup=False, compress=False, file_name=None,
+                 score_cache=False, score_max_age=None,
+                 per_state_scores=False):
         self.device = device
         self.labeled_buffer = ReplayMemory(
-            capacity_labelled, state_shape, n_actions, device)
+            capacity_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'labelled'))
         self.rank_buffer = _RankedReplayMemory(
             capacity_not_labelled, state_shape, n_actions, rank_func, AMN_net,
-            tau, device=device)
+            tau, device=device, frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'unlabelled'),
+            score_cache=score_cache, score_max_age=score_max_age,
+            per_state_scores=per_state_scores)
 
     def push(self, state, action, reward, done):
         """Saves a transition."""
         self.rank_buffer.push(state, action, reward, done)
 
+    def bump_model_version(self):
+        self.rank_buffer.bump_model_version()
+
     def label_sample(self, percentage=0.1, batch_size=64):
-        bs, ba, br, bd = self.rank_buffer.sample(
+        i = self.rank_buffer.sample_indices(
             percentage=percentage, batch_size=batch_size)
-        for i in range(bs.shape[0]):
-            self.labeled_buffer.push(bs[i], ba[i, 0], br[i, 0], bd[i, 0])
-        return bs.shape[0]
+        self.labeled_buffer.push_from(self.rank_buffer, i)
+        return i.shape[0]
 
     def sample(self, batch_size=64):
         bs, ba, br, bns, bd = self.labeled_buffer.sample(batch_size=batch_size)
@@ -342,45 +495,32 @@ class LabelledReplayMemory():
         return len(self.labeled_buffer)
 
 
-class _GeneralRankedReplayMemory(object):
+class _GeneralRankedReplayMemory(BaseReplayMemory):
     def __init__(self, capacity, state_shape, n_actions, rank_func, AMN_net,
-                 device='cuda'):
-        c, h, w = state_shape
-        self.capacity = capacity
-        self.device = device
-        self.m_states = torch.zeros((capacity, c, h, w), dtype=torch.uint8)
-        self.m_actions = torch.zeros((capacity, 1), dtype=torch.long)
-        self.m_rewards = torch.zeros((capacity, 1), dtype=torch.int8)
-        self.m_dones = torch.zeros((capacity, 1), dtype=torch.bool)
-        self.position = 0
-        self.size = 0
+                 device='cuda', frame_dedup=False, compress=False,
+                 file_name=None):
+        super(_GeneralRankedReplayMemory, self).__init__(
+            capacity, state_shape, n_actions, device, frame_dedup=frame_dedup,
+            compress=compress, file_name=file_name)
         self.rank_func = rank_func
         self.AMN_net = AMN_net
 
-    def push(self, state, action, reward, done):
-        """Saves a transition."""
-        self.m_states[self.position] = state  # 5,84,84
-        self.m_actions[self.position, 0] = action
-        self.m_rewards[self.position, 0] = reward
-        self.m_dones[self.position, 0] = done
-        self.position = (self.position + 1) % self.capacity
-        self.size = max(self.size, self.position)
+    def sample_indices(self, percentage=0.1):
+        # the rank function sees the whole memory, so only the selection
+        # itself can be bounded here
+        i = top_k_indices(
+            self.rank_func(self.AMN_net, self, device=self.device),
+            int(percentage * self.size))
+        return i[torch.randperm(i.shape[0])]
 
     def sample(self, percentage=0.1):
-        _, i = torch.sort(self.rank_func(
-            self.AMN_net, self, device=self.device), descending=True)
-        i = i[: int(percentage * self.size)]
-        i = i[torch.randperm(i.shape[0])]
-        # i = torch.randint(0, high=self.size, size=(bs,))
+        i = self.sample_indices(percentage=percentage)
         bs = self.m_states[i]
         ba = self.m_actions[i]
         br = self.m_rewards[i].float()
         bd = self.m_dones[i].float()
         return bs, ba, br, bd
 
-    def __len__(self):
-        return self.size
-
     def get_all(self):
         bs = self.m_states[:, :4]
         bns = self.m_states[:, 1:]
@@ -392,23 +532,26 @@ class _GeneralRankedReplayMemory(object):
 
 class GeneralLabeledReplayMemory():
     def __init__(self, capacity_not_labelled, capacity_labelled, state_shape,
-                 n_actions, rank_func, AMN_net, device='cuda'):
+                 n_actions, rank_func, AMN_net, device='cuda',
+                 frame_dedup=False, compress=False, file_name=None):
         self.device = device
         self.labeled_buffer = ReplayMemory(
-            capacity_labelled, state_shape, n_actions, device)
+            capacity_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'labelled'))
         self.rank_buffer = _GeneralRankedReplayMemory(
             capacity_not_labelled, state_shape, n_actions, rank_func, AMN_net,
-            device=device)
+            device=device, frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'unlabelled'))
 
     def push(self, state, action, reward, done):
         """Saves a transition."""
         self.rank_buffer.push(state, action, reward, done)
 
     def label_sample(self, percentage=0.1):
-        bs, ba, br, bd = self.rank_buffer.sample(percentage=percentage)
-        for i in range(bs.shape[0]):
-            self.labeled_buffer.push(bs[i], ba[i, 0], br[i, 0], bd[i, 0])
-        return bs.shape[0]
+        i = self.rank_buffer.sample_indices(percentage=percentage)
+        self.labeled_buffer.push_from(self.rank_buffer, i)
+        return i.shape[0]
 
     def sample(self, batch_size=None):
         bs, ba, br, bns, bd = self.labeled_buffer.sample(batch_size=batch_size)
@@ -440,68 +583,56 @@ class DuoMemory():
         return min(len(self.memory1), len(self.memory2))
 
 
-class _ObsRankedReplayMemory(object):
+class _ObsRankedReplayMemory(BaseReplayMemory):
     def __init__(self, capacity, state_shape, n_actions, rank_func, AMN_net,
-                 device='cuda'):
-        c, h, w = state_shape
-        self.capacity = capacity
-        self.device = device
-        self.m_states = torch.zeros((capacity, c, h, w), dtype=torch.uint8)
-        self.m_actions = torch.zeros((capacity, 1), dtype=torch.long)
-        self.m_rewards = torch.zeros((capacity, 1), dtype=torch.int8)
-        self.m_dones = torch.zeros((capacity, 1), dtype=torch.bool)
-        self.position = 0
-        self.size = 0
+                 device='cuda', frame_dedup=False, compress=False,
+                 file_name=None):
+        super(_ObsRankedReplayMemory, self).__init__(
+            capacity, state_shape, n_actions, device, frame_dedup=frame_dedup,
+            compress=compress, file_name=file_name)
         self.rank_func = rank_func
         self.AMN_net = AMN_net
 
-    def push(self, state, action, reward, done):
-        """Saves a transition."""
-        self.m_states[self.position] = state  # 5,84,84
-        self.m_actions[self.position, 0] = action
-        self.m_rewards[self.position, 0] = reward
-        self.m_dones[self.position, 0] = done
-        self.position = (self.position + 1) % self.capacity
-        self.size = max(self.size, self.position)
-
-    def sample(self, percentage=0.1):
+    def sample_indices(self, percentage=0.1):
         obs = (self.m_states[: self.size, :4], self.m_actions[: self.size],
                self.m_rewards[: self.size], self.m_states[: self.size, 1:],
                self.m_dones[: self.size])
-        _, i = torch.sort(self.rank_func(self.AMN_net, obs,
-                                         device=self.device), descending=True)
-        i = i[: int(percentage * self.size)]
-        i = i[torch.randperm(i.shape[0])]
-        # i = torch.randint(0, high=self.size, size=(bs,))
+        i = top_k_indices(self.rank_func(self.AMN_net, obs,
+                                         device=self.device),
+                          int(percentage * self.size))
+        return i[torch.randperm(i.shape[0])]
+
+    def sample(self, percentage=0.1):
+        i = self.sample_indices(percentage=percentage)
         bs = self.m_states[i]
         ba = self.m_actions[i]
         br = self.m_rewards[i].float()
         bd = self.m_dones[i].float()
         return bs, ba, br, bd
 
-    def __len__(self):
-        return self.size
-
 
 class ObsLabeledReplayMemory():
     def __init__(self, capacity_not_labelled, capacity_labelled, state_shape,
-                 n_actions, rank_func, AMN_net, device='cuda'):
+                 n_actions, rank_func, AMN_net, device='cuda',
+                 frame_dedup=False, compress=False, file_name=None):
         self.device = device
         self.labeled_buffer = ReplayMemory(
-            capacity_labelled, state_shape, n_actions, device)
+            capacity_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'labelled'))
         self.rank_buffer = _ObsRankedReplayMemory(
             capacity_not_labelled, state_shape, n_actions, rank_func, AMN_net,
-            device=device)
+            device=device, frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'unlabelled'))
 
     def push(self, state, action, reward, done):
         """Saves a transition."""
         self.rank_buffer.push(state, action, reward, done)
 
     def label_sample(self, percentage=0.1):
-        bs, ba, br, bd = self.rank_buffer.sample(percentage=percentage)
-        for i in range(bs.shape[0]):
-            self.labeled_buffer.push(bs[i], ba[i, 0], br[i, 0], bd[i, 0])
-        return bs.shape[0]
+        i = self.rank_buffer.sample_indices(percentage=percentage)
+        self.labeled_buffer.push_from(self.rank_buffer, i)
+        return i.shape[0]
 
     def sample(self, batch_size=None):
         bs, ba, br, bns, bd = self.labeled_buffer.sample(batch_size=batch_size)
@@ -513,41 +644,42 @@ class ObsLabeledReplayMemory():
 
 class BatchBALDReplayMemoryForMcDropout():
     def __init__(self, capacity_not_labelled, capacity_labelled, batch_label_size, state_shape,
-                 n_actions, AMN_net, num_samples, tau=0.1, device='cuda'):
+                 n_actions, AMN_net, num_samples, tau=0.1, device='cuda',
+                 frame_dedup=False, compress=False, file_name=None,
+                 feature_cache=False, feature_max_age=None):
         self.device = device
         self.n_actions = n_actions
         self.batch_label_size = batch_label_size
         self.num_samples = num_samples
         self.AMN_net = AMN_net
         self.unlabelled_buffer = _ReplayMemory(
-            capacity_not_labelled, state_shape, n_actions, device)
+            capacity_not_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'unlabelled'))
         self.labelled_buffer = ReplayMemory(
-            capacity_labelled, state_shape, n_actions, device)
+            capacity_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'labelled'))
         self.tau = tau
+        if feature_cache:
+            _enable_mc_feature_cache(
+                self.unlabelled_buffer, AMN_net, feature_max_age)
 
     def push(self, state, action, reward, done):
         self.unlabelled_buffer.push(state, action, reward, done)
 
+    def bump_trunk_version(self):
+        self.unlabelled_buffer.bump_trunk_version()
+
     def label_sample(self, batch_size=64, num_batch_samples=100):
-        bs, ba, br, bd = self.unlabelled_buffer.sample()
-        num_states = bs.shape[0]
-        out = torch.empty(
-            (num_states, self.num_samples, self.n_actions))
-        for i in range(self.num_samples):
-            for j in range(0, num_states, batch_size):
-                next_batch_size = batch_size
-                if (num_states - j < batch_size):
-                    next_batch_size = num_states - j
-                next_states = bs[j:j + next_batch_size, :4].to(self.device)
-                with torch.no_grad():
-                    out[j:j + next_batch_size, i,
-                        :] = self.AMN_net(next_states)
+        out = _mc_pool_q_values(self.AMN_net, self.unlabelled_buffer,
+                                self.num_samples, self.n_actions, batch_size,
+                                self.device)
         prob = (out / self.tau).softmax(dim=2)
         candidates = get_batchbald_batch(
             prob, self.batch_label_size, num_batch_samples, device=self.device)
-        for indice in candidates.indices:
-            self.labelled_buffer.push(
-                bs[indice], ba[indice], br[indice], bd[indice])
+        self.labelled_buffer.push_from(
+            self.unlabelled_buffer, candidates.indices)
 
     def sample(self, batch_size=None):
         bs, ba, br, bns, bd = self.labelled_buffer.sample(
@@ -560,42 +692,44 @@ class BatchBALDReplayMemoryForMcDropout():
 
 class BALDReplayMemoryForMcDropout():
     def __init__(self, capacity_not_labelled, capacity_labelled, batch_label_size, state_shape,
-                 n_actions, AMN_net, num_samples, tau=0.1, device='cuda'):
+                 n_actions, AMN_net, num_samples, tau=0.1, device='cuda',
+                 frame_dedup=False, compress=False, file_name=None,
+                 feature_cache=False, feature_max_age=None):
         self.device = device
         self.n_actions = n_actions
         self.batch_label_size = batch_label_size
         self.num_samples = num_samples
         self.AMN_net = AMN_net
         self.unlabelled_buffer = _ReplayMemory(
-            capacity_not_labelled, state_shape, n_actions, device)
+            capacity_not_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'unlabelled'))
         self.labelled_buffer = ReplayMemory(
-            capacity_labelled, state_shape, n_actions, device)
+            capacity_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'labelled'))
         self.tau = tau
+        if feature_cache:
+            _enable_mc_feature_cache(
+                self.unlabelled_buffer, AMN_net, feature_max_age)
 
     def push(self, state, action, reward, done):
         self.unlabelled_buffer.push(state, action, reward, done)
 
+    def bump_trunk_version(self):
+        self.unlabelled_buffer.bump_trunk_version()
+
     def label_sample(self, batch_size=64):
-        bs, ba, br, bd = self.unlabelled_buffer.sample()
-        num_states = bs.shape[0]
-        out = torch.empty(
-            (num_states, self.num_samples, self.n_actions))
-        for i in range(self.num_samples):
-            for j in range(0, num_states, batch_size):
-                next_batch_size = batch_size
-                if (num_states - j < batch_size):
-                    next_batch_size = num_states - j
-                next_states = bs[j:j + next_batch_size, :4].to(self.device)
-                with torch.no_grad():
-                    out[j:j + next_batch_size, i] = self.AMN_net(next_states)
+        out = _mc_pool_q_values(self.AMN_net, self.unlabelled_buffer,
+                                self.num_samples, self.n_actions, batch_size,
+                                self.device)
         prob = (out / self.tau).softmax(dim=2)
 
         candidates = get_bald_batch(
             prob, self.batch_label_size, device=self.device)
 
-        for indice in candidates.indices:
-            self.labelled_buffer.push(
-                bs[indice], ba[indice], br[indice], bd[indice])
+        self.labelled_buffer.push_from(
+            self.unlabelled_buffer, candidates.indices)
 
     def sample(self, batch_size=None):
         bs, ba, br, bns, bd = self.labelled_buffer.sample(
@@ -608,27 +742,29 @@ class BALDReplayMemoryForMcDropout():
 
 class RandomReplayMemoryForMcDropout():
     def __init__(self, capacity_not_labelled, capacity_labelled, batch_label_size, state_shape,
-                 n_actions, AMN_net, num_samples, device='cuda'):
+                 n_actions, AMN_net, num_samples, device='cuda',
+                 frame_dedup=False, compress=False, file_name=None):
         self.device = device
         self.n_actions = n_actions
         self.batch_label_size = batch_label_size
         self.num_samples = num_samples
         self.AMN_net = AMN_net
         self.unlabelled_buffer = _ReplayMemory(
-            capacity_not_labelled, state_shape, n_actions, device)
+            capacity_not_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'unlabelled'))
         self.labelled_buffer = ReplayMemory(
-            capacity_labelled, state_shape, n_actions, device)
+            capacity_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'labelled'))
 
     def push(self, state, action, reward, done):
         self.unlabelled_buffer.push(state, action, reward, done)
 
     def label_sample(self, batch_size=64):
-        bs, ba, br, bd = self.unlabelled_buffer.sample()
-        num_states = bs.shape[0]
+        num_states = len(self.unlabelled_buffer)
         indices = random.sample(range(num_states), self.batch_label_size)
-        for indice in indices:
-            self.labelled_buffer.push(
-                bs[indice], ba[indice], br[indice], bd[indice])
+        self.labelled_buffer.push_from(self.unlabelled_buffer, indices)
 
     def sample(self, batch_size=None):
         bs, ba, br, bns, bd = self.labelled_buffer.sample(
@@ -641,44 +777,44 @@ class RandomReplayMemoryForMcDropout():
 
 class BALDReplayMemoryForEnsDQN():
     def __init__(self, capacity_not_labelled, capacity_labelled, state_shape,
-                 n_actions, AMN_net, tau=0.1, device='cuda'):
+                 n_actions, AMN_net, tau=0.1, device='cuda',
+                 frame_dedup=False, compress=False, file_name=None,
+                 score_cache=False, score_max_age=None):
         self.device = device
         self.n_actions = n_actions
         self.AMN_net = AMN_net
         self.unlabelled_buffer = _ReplayMemory(
-            capacity_not_labelled, state_shape, n_actions, device)
+            capacity_not_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'unlabelled'))
         self.labelled_buffer = ReplayMemory(
-            capacity_labelled, state_shape, n_actions, device)
+            capacity_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'labelled'))
         self.tau = tau
+        if score_cache:
+            _enable_ens_score_cache(
+                self.unlabelled_buffer, AMN_net, n_actions, score_max_age)
 
     def push(self, state, action, reward, done):
         self.unlabelled_buffer.push(state, action, reward, done)
 
+    def bump_model_version(self):
+        self.unlabelled_buffer.bump_model_version()
+
     def label_sample(self, batch_label_size, batch_size=64):
-        bs, ba, br, bd = self.unlabelled_buffer.sample()
-        num_states = bs.shape[0]
-        out = torch.empty(
-            (num_states, self.AMN_net.get_num_ensembles(), self.n_actions))
-        for j in range(0, num_states, batch_size):
-            next_batch_size = batch_size
-            if (num_states - j < batch_size):
-                next_batch_size = num_states - j
-            next_states = bs[j:j + next_batch_size, :4].to(self.device)
-            for i in range(self.AMN_net.get_num_ensembles()):
-                with torch.no_grad():
-                    out[j:j + next_batch_size, i,
-                        :] = self.AMN_net(next_states, ens_num=i).cpu()
+        out = self.unlabelled_buffer.score_candidates(
+            lambda states: _ens_q_values(
+                self.AMN_net, states, self.n_actions, batch_size,
+                self.device))
         prob = (out / self.tau).softmax(dim=2)
 
         candidates = get_bald_batch(
             prob, batch_label_size, device=self.device)
 
-        num_samples = 0
-        for indice in candidates.indices:
-            self.labelled_buffer.push(
-                bs[indice], ba[indice], br[indice], bd[indice])
-            num_samples += 1
-        return num_samples
+        self.labelled_buffer.push_from(
+            self.unlabelled_buffer, candidates.indices)
+        return len(candidates.indices)
 
     def sample(self, batch_size=None):
         bs, ba, br, bns, bd = self.labelled_buffer.sample(
@@ -691,44 +827,44 @@ class BALDReplayMemoryForEnsDQN():
 
 class BatchBALDReplayMemoryForEnsDQN():
     def __init__(self, capacity_not_labelled, capacity_labelled, state_shape,
-                 n_actions, AMN_net, tau=0.1, device='cuda'):
+                 n_actions, AMN_net, tau=0.1, device='cuda',
+                 frame_dedup=False, compress=False, file_name=None,
+                 score_cache=False, score_max_age=None):
         self.device = device
         self.n_actions = n_actions
         self.AMN_net = AMN_net
         self.unlabelled_buffer = _ReplayMemory(
-            capacity_not_labelled, state_shape, n_actions, device)
+            capacity_not_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'unlabelled'))
         self.labelled_buffer = ReplayMemory(
-            capacity_labelled, state_shape, n_actions, device)
+            capacity_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'labelled'))
         self.tau = tau
+        if score_cache:
+            _enable_ens_score_cache(
+                self.unlabelled_buffer, AMN_net, n_actions, score_max_age)
 
     def push(self, state, action, reward, done):
         self.unlabelled_buffer.push(state, action, reward, done)
 
+    def bump_model_version(self):
+        self.unlabelled_buffer.bump_model_version()
+
     def label_sample(self, batch_label_size, num_samples, batch_size=64):
-        bs, ba, br, bd = self.unlabelled_buffer.sample()
-        num_states = bs.shape[0]
-        out = torch.empty(
-            (num_states, self.AMN_net.get_num_ensembles(), self.n_actions))
-        for j in range(0, num_states, batch_size):
-            next_batch_size = batch_size
-            if (num_states - j < batch_size):
-                next_batch_size = num_states - j
-            next_states = bs[j:j + next_batch_size, :4].to(self.device)
-            for i in range(self.AMN_net.get_num_ensembles()):
-                with torch.no_grad():
-                    out[j:j + next_batch_size, i,
-                        :] = self.AMN_net(next_states, ens_num=i).cpu()
+        out = self.unlabelled_buffer.score_candidates(
+            lambda states: _ens_q_values(
+                self.AMN_net, states, self.n_actions, batch_size,
+                self.device))
         prob = (out / self.tau).softmax(dim=2)
 
         candidates = get_batchbald_batch(
             prob, batch_label_size, num_samples, device=self.device)
 
-        num_samples = 0
-        for indice in candidates.indices:
-            self.labelled_buffer.push(
-                bs[indice], ba[indice], br[indice], bd[indice])
-            num_samples += 1
-        return num_samples
+        self.labelled_buffer.push_from(
+            self.unlabelled_buffer, candidates.indices)
+        return len(candidates.indices)
 
     def sample(self, batch_size=None):
         bs, ba, br, bns, bd = self.labelled_buffer.sample(
@@ -741,7 +877,8 @@ class BatchBALDReplayMemoryForEnsDQN():
 
 class DoubleRankedReplayMemoryForEnsDQN():
     def __init__(self, capacity_not_labelled, capacity_labelled, batch_label_size, state_shape,
-                 n_actions, net1, net2, rank_func1, rank_func2, tau=0.1, device='cuda'):
+                 n_actions, net1, net2, rank_func1, rank_func2, tau=0.1, device='cuda',
+                 frame_dedup=False, compress=False, file_name=None):
         self.device = device
         self.n_actions = n_actions
         self.batch_label_size = batch_label_size
@@ -750,20 +887,24 @@ class DoubleRankedReplayMemoryForEnsDQN():
         self.rank_func1 = rank_func1
         self.rank_func2 = rank_func2
         self.unlabelled_buffer = _ReplayMemory(
-            capacity_not_labelled, state_shape, n_actions, device)
+            capacity_not_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'unlabelled'))
         self.labelled_buffer = ReplayMemory(
-            capacity_labelled, state_shape, n_actions, device)
+            capacity_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'labelled'))
         self.tau = tau
 
     def push(self, state, action, reward, done):
         self.unlabelled_buffer.push(state, action, reward, done)
 
     def label_sample(self, batch_size=64, device='cuda'):
-        bs, ba, br, bd = self.unlabelled_buffer.sample()
+        bs = self.unlabelled_buffer.candidates()[:, :4]
         rank_val1 = self.rank_func1(
-            self.net1, bs[:, :4], batch_size=batch_size, device=device)
+            self.net1, bs, batch_size=batch_size, device=device)
         rank_val2 = self.rank_func2(
-            self.net2, bs[:, :4], batch_size=batch_size, device=device)
+            self.net2, bs, batch_size=batch_size, device=device)
 
         rank_val1 += torch.min(rank_val1)
         rank_val1 /= torch.max(rank_val1)
@@ -773,16 +914,11 @@ class DoubleRankedReplayMemoryForEnsDQN():
 
         rank_val = rank_val1 * rank_val2
 
-        _, i = torch.sort(rank_val, descending=True)
-
-        i = i[: self.batch_label_size]
+        selected = top_k_indices(rank_val, self.batch_label_size)
 
-        i = i[torch.randperm(i.shape[0])]
+        selected = selected[torch.randperm(selected.shape[0])]
 
-        for j in range(self.batch_label_size):
-            next_index = i[j]
-            self.labelled_buffer.push(
-                bs[next_index], ba[next_index], br[next_index], bd[next_index])
+        self.labelled_buffer.push_from(self.unlabelled_buffer, selected)
 
     def sample(self, batch_size=None):
         bs, ba, br, bns, bd = self.labelled_buffer.sample(
@@ -795,7 +931,8 @@ class DoubleRankedReplayMemoryForEnsDQN():
 
 class DoubleRankedReplayMemoryForEnsDQNV2():
     def __init__(self, capacity_not_labelled, capacity_labelled, batch_label_size, state_shape,
-                 n_actions, net1, net2, rank_func1, rank_func2, tau=0.1, device='cuda'):
+                 n_actions, net1, net2, rank_func1, rank_func2, tau=0.1, device='cuda',
+                 frame_dedup=False, compress=False, file_name=None):
         self.device = device
         self.n_actions = n_actions
         self.batch_label_size = batch_label_size
@@ -804,16 +941,20 @@ class DoubleRankedReplayMemoryForEnsDQNV2():
         self.rank_func1 = rank_func1
         self.rank_func2 = rank_func2
         self.unlabelled_buffer = _ReplayMemory(
-            capacity_not_labelled, state_shape, n_actions, device)
+            capacity_not_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'unlabelled'))
         self.labelled_buffer = ReplayMemory(
-            capacity_labelled, state_shape, n_actions, device)
+            capacity_labelled, state_shape, n_actions, device,
+            frame_dedup=frame_dedup, compress=compress,
+            file_name=_buffer_file_name(file_name, 'labelled'))
         self.tau = tau
 
     def push(self, state, action, reward, done):
         self.unlabelled_buffer.push(state, action, reward, done)
 
     def label_sample(self, batch_size=64, device='cuda'):
-        bs, ba, br, bd = self.unlabelled_buffer.sample()
+        bs = self.unlabelled_buffer.candidates()
         rank_val1 = self.rank_func1(
             self.net1, bs, batch_size=batch_size, device=device)
         rank_val2 = self.rank_func2(
@@ -827,16 +968,11 @@ class DoubleRankedReplayMemoryForEnsDQNV2():
 
         rank_val = rank_val1 * rank_val2
 
-        _, i = torch.sort(rank_val, descending=True)
+        selected = top_k_indices(rank_val, self.batch_label_size)
 
-        i = i[: self.batch_label_size]
-
-        i = i[torch.randperm(i.shape[0])]
+        selected = selected[torch.randperm(selected.shape[0])]
 
-        for j in range(self.batch_label_size):
-            next_index = i[j]
-            self.labelled_buffer.push(
-                bs[next_index], ba[next_index], br[next_index], bd[next_index])
+        self.labelled_buffer.push_from(self.unlabelled_buffer, selected)
 
     def sample(self, batch_size=None):
         bs, ba, br, bns, bd = self.labelled_buffer.sample(
@@ -0,0 +1,95 @@
+import queue
+import threading
+import time
+import torch
+
+
+class PrefetchMemory(object):
+    """Samples batches of ``memory`` ahead of time in a background thread.
+
+    Up to ``num_batches`` batches of ``batch_size`` are gathered into a ring
+    of reusable (pinned, when CUDA is available) buffers while the optimizer
+    runs its forward and backward passes. The wrapper exposes ``sample`` and
+    ``__len__`` like any memory, so the functions in ``optimization.py`` take
+    it unchanged. The tensors returned by ``sample`` stay valid until the
+    next call, when their buffer is handed back to the producer. Pushes made
+    through the wrapper are serialised with the producer's gathers.
+    """
+
+    def __init__(self, memory, batch_size, num_batches=2, device=None):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.device = device
+        self.lock = threading.Lock()
+        self.pin_memory = torch.cuda.is_available()
+        self.free_buffers = queue.Queue()
+        self.ready_batches = queue.Queue()
+        for _ in range(num_batches):
+            self.free_buffers.put(None)
+        self.current = None
+        self.running = True
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def push(self, *args, **kwargs):
+        with self.lock:
+            self.memory.push(*args, **kwargs)
+
+    def push_batch(self, *args, **kwargs):
+        with self.lock:
+            self.memory.push_batch(*args, **kwargs)
+
+    def sample(self, batch_size=None):
+        if batch_size is not None and batch_size != self.batch_size:
+            with self.lock:
+                return self.memory.sample(batch_size)
+        if self.current is not None:
+            self.free_buffers.put(self.current)
+        self.current = self.ready_batches.get()
+        buffers, event = self.current
+        if self.device is None:
+            return buffers
+        batch = tuple(b.to(self.device, non_blocking=True) for b in buffers)
+        if event is not None:
+            event.record()
+        return batch
+
+    def close(self):
+        """Stops the producer thread."""
+        self.running = False
+        self.free_buffers.put(None)
+        self.thread.join()
+
+    def _produce(self):
+        while True:
+            item = self.free_buffers.get()
+            if not self.running:
+                return
+            if item is not None and item[1] is not None:
+                # the previous host-to-device copy may still read the buffer
+                item[1].synchronize()
+            while len(self.memory) < self.batch_size and self.running:
+                time.sleep(0.01)
+            if not self.running:
+                return
+            with self.lock:
+                batch = self.memory.sample(self.batch_size)
+            buffers = self._fill(None if item is None else item[0], batch)
+            event = None
+            if self.pin_memory and self.device is not None and \
+                    torch.device(self.device).type == 'cuda':
+                event = torch.cuda.Event()
+            self.ready_batches.put((buffers, event))
+
+    def _fill(self, buffers, batch):
+        if buffers is None or any(b.shape != t.shape or b.dtype != t.dtype
+                                  for b, t in zip(buffers, batch)):
+            buffers = tuple(torch.empty(t.shape, dtype=t.dtype,
+                                        pin_memory=self.pin_memory)
+                            for t in batch)
+        for b, t in zip(buffers, batch):
+            b.copy_(t)
+        return buffers
+
+    def __len__(self):
+        return len(self.memory)
@@ -0,0 +1,42 @@
+import torch
+
+SCORE_CHUNK_SIZE = 4096
+
+
+class TopK(object):
+    """Running top-k over scores that arrive chunk by chunk.
+
+    At most ``k`` scores and indices are kept between chunks, so selecting
+    from N candidates never holds an N-sized score or index permutation.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.values = torch.empty(0)
+        self.indices = torch.empty(0, dtype=torch.long)
+
+    def update(self, start, scores):
+        """Merges the scores of candidates ``start`` to ``start + len``."""
+        scores = scores.detach().flatten().to('cpu', torch.float)
+        values = torch.cat((self.values, scores))
+        indices = torch.cat((self.indices, torch.arange(
+            start, start + scores.shape[0])))
+        if values.shape[0] > self.k:
+            values, top = torch.topk(values, self.k)
+            indices = indices[top]
+        self.values = values
+        self.indices = indices
+
+
+def top_k(chunks, k):
+    """Indices of the ``k`` highest scores in ``(start, scores)`` chunks."""
+    selector = TopK(k)
+    for start, scores in chunks:
+        selector.update(start, scores)
+    return selector.indices
+
+
+def top_k_indices(scores, k, chunk_size=SCORE_CHUNK_SIZE):
+    """Indices of the ``k`` highest entries of an already computed vector."""
+    return top_k(((start, scores[start: start + chunk_size])
+                  for start in range(0, scores.shape[0], chunk_size)), k)
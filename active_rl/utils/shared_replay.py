@@ -0,0 +1,97 @@
+import multiprocessing
+import torch
+from .memory import ReplayMemory
+
+
+class SharedReplayMemory(ReplayMemory):
+    """ReplayMemory whose storage lives in shared memory.
+
+    Pass the memory to worker processes (``torch.multiprocessing``) and every
+    copy reads and writes the same tensors. The write cursor is a shared
+    tensor guarded by a lock that is only held to reserve and commit slots,
+    so actors copy their transitions concurrently. Each slot is flagged once
+    its write finishes and ``size`` only advances over the contiguous range
+    of flagged slots, so before the memory first wraps around a sampler
+    never sees a slot that is still being written. After that, a slot that
+    is being overwritten may be sampled, as with any asynchronously filled
+    replay buffer.
+    """
+
+    def __init__(self, capacity, state_shape, n_actions, device, lock=None,
+                 reuse_buffers=False):
+        # [position, size]
+        self.m_cursor = torch.zeros(2, dtype=torch.long).share_memory_()
+        self.m_committed = torch.zeros(
+            capacity, dtype=torch.bool).share_memory_()
+        self.lock = multiprocessing.Lock() if lock is None else lock
+        super(SharedReplayMemory, self).__init__(
+            capacity, state_shape, n_actions, device,
+            reuse_buffers=reuse_buffers)
+        for field in (self.m_states, self.m_actions, self.m_rewards,
+                      self.m_dones):
+            field.share_memory_()
+
+    @property
+    def position(self):
+        return int(self.m_cursor[0])
+
+    @position.setter
+    def position(self, value):
+        self.m_cursor[0] = value
+
+    @property
+    def size(self):
+        return int(self.m_cursor[1])
+
+    @size.setter
+    def size(self, value):
+        self.m_cursor[1] = value
+
+    def push(self, state, action, reward, done):
+        """Saves a transition."""
+        with self.lock:
+            slot = self.position
+            self.position = (slot + 1) % self.capacity
+        self.m_states[slot] = state
+        self.m_actions[slot, 0] = action
+        self.m_rewards[slot, 0] = reward
+        self.m_dones[slot, 0] = done
+        self._invalidate(slot, slot + 1)
+        with self.lock:
+            self._commit(torch.tensor([slot]))
+
+    def push_batch(self, states, actions, rewards, dones):
+        with self.lock:
+            size = self.size
+            super(SharedReplayMemory, self).push_batch(
+                states, actions, rewards, dones)
+            self.size = size
+            self._commit(self._newest_slots(states.shape[0]))
+
+    def push_from(self, memory, indices):
+        with self.lock:
+            size = self.size
+            super(SharedReplayMemory, self).push_from(memory, indices)
+            self.size = size
+            self._commit(self._newest_slots(len(indices)))
+
+    def remove(self, indices):
+        with self.lock:
+            super(SharedReplayMemory, self).remove(indices)
+            self.m_committed[self.size:] = False
+
+    def _newest_slots(self, num_transitions):
+        num_transitions = min(num_transitions, self.capacity)
+        return (self.position - num_transitions +
+                torch.arange(num_transitions)) % self.capacity
+
+    def _commit(self, slots):
+        """Flags ``slots`` as written and advances ``size`` over the
+        contiguous prefix of written slots. Called with the lock held."""
+        self.m_committed[slots] = True
+        size = self.size
+        pending = (~self.m_committed[size:]).nonzero()
+        if pending.shape[0] == 0:
+            self.size = self.capacity
+        else:
+            self.size = size + int(pending[0])
@@ -0,0 +1,545 @@
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from .selection import SCORE_CHUNK_SIZE, top_k, top_k_indices
+
+
+class FrameStackStorage(object):
+    """Frame-deduplicated stand-in for the (capacity, c, h, w) state tensor.
+
+    Consecutive transitions of an episode share c - 1 of their c frames, so
+    every frame is kept once in a pool and each slot only stores the indices
+    of its frames. A pushed stack whose leading frames match the trailing
+    frames of the previously written slot reuses them, which makes the index
+    table the episode-boundary metadata. Indexing works like the dense
+    tensor (e.g. ``storage[i, :4]``) and rebuilds the stacks at gather time.
+    """
+
+    def __init__(self, capacity, state_shape):
+        c, h, w = state_shape
+        self.shape = torch.Size((capacity, c, h, w))
+        self.dtype = torch.uint8
+        # frame 0 stays blank so unwritten slots read as zeros
+        num_frames = capacity + c + 1
+        self.m_frames = torch.zeros((num_frames, h, w), dtype=torch.uint8)
+        self.m_frame_index = torch.zeros((capacity, c), dtype=torch.long)
+        self.slot_frames = [None] * capacity
+        self.frame_refs = [0] * num_frames
+        self.free_frames = list(range(num_frames - 1, 0, -1))
+        self.last_slot = None
+
+    def __getitem__(self, key):
+        return self.m_frames[self.m_frame_index[key]]
+
+    def __setitem__(self, key, states):
+        if isinstance(key, slice):
+            for slot, state in zip(range(*key.indices(len(self))), states):
+                self._write(slot, state)
+        else:
+            self._write(key, states)
+
+    def _write(self, slot, state):
+        c = self.shape[1]
+        state = state.reshape(self.shape[1:])
+        frames = self._shared_frames(state)
+        if frames is None:
+            frames = [self._allocate() for _ in range(c)]
+            self.m_frames[frames] = state
+        else:
+            frames.append(self._allocate())
+            self.m_frames[frames[-1]] = state[-1]
+        for frame in frames:
+            self.frame_refs[frame] += 1
+        self._release(slot)
+        self.slot_frames[slot] = frames
+        self.m_frame_index[slot] = torch.tensor(frames)
+        self.last_slot = slot
+
+    def __len__(self):
+        return self.shape[0]
+
+    def copy_rows(self, destination, source):
+        """Points the ``destination`` slots at the frames of ``source``."""
+        for dst, src in zip(destination.tolist(), source.tolist()):
+            frames = list(self.slot_frames[src])
+            for frame in frames:
+                self.frame_refs[frame] += 1
+            self._release(dst)
+            self.slot_frames[dst] = frames
+        self.m_frame_index[destination] = self.m_frame_index[source]
+
+    def _shared_frames(self, state):
+        if self.last_slot is None:
+            return None
+        previous = self.slot_frames[self.last_slot][1:]
+        if torch.equal(self.m_frames[previous], state[:-1]):
+            return list(previous)
+        return None
+
+    def _allocate(self):
+        if not self.free_frames:
+            self._grow()
+        return self.free_frames.pop()
+
+    def _release(self, slot):
+        if self.slot_frames[slot] is None:
+            return
+        for frame in self.slot_frames[slot]:
+            self.frame_refs[frame] -= 1
+            if self.frame_refs[frame] == 0:
+                self.free_frames.append(frame)
+        self.slot_frames[slot] = None
+
+    def _grow(self):
+        # every episode boundary costs c - 1 extra frames, so the pool grows
+        # in large steps instead of reserving the worst case up front
+        num_frames = self.m_frames.shape[0]
+        extra = max(num_frames // 8, self.shape[1])
+        self.m_frames = torch.cat((self.m_frames, torch.zeros(
+            (extra,) + tuple(self.shape[2:]), dtype=torch.uint8)))
+        self.frame_refs += [0] * extra
+        self.free_frames += range(num_frames + extra - 1, num_frames - 1, -1)
+
+
+class CompressedStateStorage(object):
+    """zlib-compressed stand-in for the (capacity, c, h, w) state tensor.
+
+    Every frame is compressed on its own. With ``delta`` the frames after
+    the first of a stack are stored as differences to their predecessor,
+    which suits the small changes between consecutive Atari frames. Frames
+    shared with the previously written stack reuse its compressed bytes.
+    Gathered rows are decompressed on a thread pool, since zlib releases
+    the GIL while it works.
+    """
+
+    def __init__(self, capacity, state_shape, delta=False, level=1,
+                 num_workers=4):
+        c, h, w = state_shape
+        self.shape = torch.Size((capacity, c, h, w))
+        self.dtype = torch.uint8
+        self.delta = delta
+        self.level = level
+        self.num_workers = num_workers
+        self.slot_frames = [None] * capacity
+        self.last_state = None
+        self.last_frames = None
+        self.executor = ThreadPoolExecutor(num_workers)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        rows = torch.arange(len(self))[key[0]]
+        if rows.dim() == 0:
+            return torch.from_numpy(self._decode(int(rows)))[key[1:]]
+        states = np.empty((rows.shape[0],) + tuple(self.shape[1:]),
+                          dtype=np.uint8)
+        groups = np.array_split(np.arange(rows.shape[0]), self.num_workers)
+        rows = rows.tolist()
+        list(self.executor.map(
+            lambda group: self._decode_rows(states, group, rows), groups))
+        return torch.from_numpy(states)[(slice(None),) + key[1:]]
+
+    def __setitem__(self, key, states):
+        if isinstance(key, slice):
+            for slot, state in zip(range(*key.indices(len(self))), states):
+                self._write(slot, state)
+        else:
+            self._write(key, states)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def copy_rows(self, destination, source):
+        """Points the ``destination`` slots at the frames of ``source``."""
+        for dst, src in zip(destination.tolist(), source.tolist()):
+            self.slot_frames[dst] = self.slot_frames[src]
+
+    def _write(self, slot, state):
+        state = torch.as_tensor(state).reshape(self.shape[1:]).numpy().copy()
+        if self.last_state is not None and \
+                np.array_equal(self.last_state[1:], state[:-1]):
+            frames = self.last_frames[1:]
+            if self.delta:
+                # the new first frame has no predecessor in its stack
+                frames[0] = self._compress(state[0])
+                frames.append(self._compress(state[-1] - state[-2]))
+            else:
+                frames.append(self._compress(state[-1]))
+        else:
+            encoded = state.copy()
+            if self.delta:
+                encoded[1:] = state[1:] - state[:-1]
+            frames = [self._compress(frame) for frame in encoded]
+        self.slot_frames[slot] = frames
+        self.last_state = state
+        self.last_frames = frames
+
+    def _compress(self, frame):
+        return zlib.compress(frame.tobytes(), self.level)
+
+    def _decode(self, slot):
+        frames = self.slot_frames[slot]
+        if frames is None:
+            return np.zeros(tuple(self.shape[1:]), dtype=np.uint8)
+        state = np.stack([np.frombuffer(zlib.decompress(frame), np.uint8)
+                          for frame in frames]).reshape(self.shape[1:])
+        if self.delta:
+            for k in range(1, state.shape[0]):
+                state[k] += state[k - 1]
+        return state
+
+    def _decode_rows(self, states, group, rows):
+        for position in group:
+            states[position] = self._decode(rows[position])
+
+
+def open_memmap(file_name, shape, dtype):
+    """Maps ``file_name`` as a tensor, creating a zeroed file if needed."""
+    mode = 'r+' if os.path.exists(file_name) else 'w+'
+    array = np.memmap(file_name, dtype=dtype, mode=mode, shape=tuple(shape))
+    return torch.from_numpy(array), array
+
+
+class SlotCache(object):
+    """Per-slot values tagged with the model version they were computed with.
+
+    A slot is stale when it was never computed, was overwritten since, or
+    its version is older than the current one (by more than ``max_age``
+    versions when an age limit is given).
+    """
+
+    def __init__(self, capacity, shape=(), dtype=torch.float):
+        self.m_values = torch.zeros((capacity,) + tuple(shape), dtype=dtype)
+        self.m_versions = torch.full((capacity,), -1, dtype=torch.long)
+
+    def invalidate(self, start, end):
+        self.m_versions[start:end] = -1
+
+    def stale(self, size, version, max_age=None):
+        versions = self.m_versions[:size]
+        if max_age is None:
+            stale = versions != version
+        else:
+            stale = (versions < 0) | (versions < version - max_age)
+        return stale.nonzero().flatten()
+
+    def update(self, slots, values, version):
+        self.m_values[slots] = values.to(self.m_values.device,
+                                         self.m_values.dtype)
+        self.m_versions[slots] = version
+
+    def copy_rows(self, destination, source):
+        self.m_values[destination] = self.m_values[source]
+        self.m_versions[destination] = self.m_versions[source]
+
+
+class BaseReplayMemory(object):
+    def __init__(self, capacity, state_shape, n_actions, device=None,
+                 frame_dedup=False, compress=False, file_name=None):
+        c, h, w = state_shape
+        self.capacity = capacity
+        self.device = device
+        self.file_name = file_name
+        self.m_meta = None
+        self.position = 0
+        self.size = 0
+        self.score_cache = None
+        self.score_max_age = None
+        self.model_version = 0
+        self.feature_cache = None
+        self.feature_max_age = None
+        self.trunk_version = 0
+        if frame_dedup and compress:
+            raise ValueError('frame_dedup and compress cannot be combined')
+        if file_name is not None:
+            if frame_dedup or compress:
+                raise ValueError('frame_dedup and compress are not supported '
+                                 'for memory-mapped memories')
+            self._open_files(file_name, (c, h, w))
+            return
+        if frame_dedup:
+            self.m_states = FrameStackStorage(capacity, state_shape)
+        elif compress:
+            # compress='delta' additionally delta-encodes each stack
+            self.m_states = CompressedStateStorage(
+                capacity, state_shape, delta=compress == 'delta')
+        else:
+            self.m_states = torch.zeros((capacity, c, h, w), dtype=torch.uint8)
+        self.m_actions = torch.zeros((capacity, 1), dtype=torch.long)
+        # rewards and dones are kept in the dtype the optimizers consume
+        self.m_rewards = torch.zeros((capacity, 1), dtype=torch.float)
+        self.m_dones = torch.zeros((capacity, 1), dtype=torch.float)
+
+    def _open_files(self, file_name, state_shape):
+        # the meta file holds [capacity, c, h, w, position, size]; it is
+        # updated after every push so an existing buffer can be reopened
+        exists = os.path.exists(f'{file_name}.meta')
+        self.m_meta, meta = open_memmap(f'{file_name}.meta', (6,), np.int64)
+        if exists:
+            shape = meta[:4].tolist()
+            if shape != [self.capacity] + list(state_shape):
+                raise ValueError(
+                    f'{file_name} was created with capacity {shape[0]} and '
+                    f'state shape {tuple(shape[1:])}')
+            self.position = int(meta[4])
+            self.size = int(meta[5])
+        else:
+            meta[:4] = (self.capacity,) + tuple(state_shape)
+        self.m_states, states = open_memmap(
+            f'{file_name}.states', (self.capacity,) + tuple(state_shape),
+            np.uint8)
+        self.m_actions, actions = open_memmap(
+            f'{file_name}.actions', (self.capacity, 1), np.int64)
+        self.m_rewards, rewards = open_memmap(
+            f'{file_name}.rewards', (self.capacity, 1), np.float32)
+        self.m_dones, dones = open_memmap(
+            f'{file_name}.dones', (self.capacity, 1), np.float32)
+        self._memmaps = [states, actions, rewards, dones, meta]
+
+    def push(self, state, action, reward, done):
+        """Saves a transition."""
+        self.m_states[self.position] = state  # 5,84,84
+        self.m_actions[self.position, 0] = action
+        self.m_rewards[self.position, 0] = reward
+        self.m_dones[self.position, 0] = done
+        self._invalidate(self.position, self.position + 1)
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self._sync_meta()
+
+    def push_batch(self, states, actions, rewards, dones):
+        """Saves a batch of transitions with at most two copies per field."""
+        states = states.reshape((-1,) + tuple(self.m_states.shape[1:]))
+        actions = torch.as_tensor(actions).reshape(-1, 1)
+        rewards = torch.as_tensor(rewards).reshape(-1, 1)
+        dones = torch.as_tensor(dones).reshape(-1, 1)
+        num_transitions = states.shape[0]
+        if num_transitions > self.capacity:
+            # only the newest capacity transitions would survive anyway
+            skipped = num_transitions - self.capacity
+            states, actions = states[skipped:], actions[skipped:]
+            rewards, dones = rewards[skipped:], dones[skipped:]
+            self.position = (self.position + skipped) % self.capacity
+            self.size = self.capacity
+            num_transitions = self.capacity
+        first = min(num_transitions, self.capacity - self.position)
+        self._write_slice(self.position, states[:first], actions[:first],
+                          rewards[:first], dones[:first])
+        if first < num_transitions:
+            self._write_slice(0, states[first:], actions[first:],
+                              rewards[first:], dones[first:])
+        self.position = (self.position + num_transitions) % self.capacity
+        self.size = min(self.size + num_transitions, self.capacity)
+        self._sync_meta()
+
+    def enable_score_cache(self, shape=(), max_age=None, per_state=True):
+        """Keeps a ``shape``-sized score per slot between labelling rounds.
+
+        Scores are recomputed for overwritten slots and, after a call to
+        ``bump_model_version``, for all slots, or only for those more than
+        ``max_age`` versions old. Cached and fresh scores are mixed, so the
+        score of a state must not depend on the rest of the pool; rank
+        functions that normalise over the pool pass ``per_state=False`` and
+        are refused.
+        """
+        if not per_state:
+            raise ValueError('score_cache needs a rank function that scores '
+                             'each state independently (per_state_scores)')
+        self.score_cache = SlotCache(self.capacity, shape)
+        self.score_max_age = max_age
+
+    def bump_model_version(self):
+        """Marks the scores computed so far as coming from an older model."""
+        self.model_version += 1
+
+    def enable_feature_cache(self, num_features=512, max_age=None):
+        """Keeps the penultimate features of every slot as float16.
+
+        Features are recomputed for overwritten slots and, after a call to
+        ``bump_trunk_version``, for all slots, or only for those more than
+        ``max_age`` versions old.
+        """
+        self.feature_cache = SlotCache(self.capacity, (num_features,),
+                                       torch.float16)
+        self.feature_max_age = max_age
+
+    def bump_trunk_version(self):
+        """Marks the features computed so far as coming from an older trunk."""
+        self.trunk_version += 1
+
+    def cached_features(self, feature_func, chunk_size=SCORE_CHUNK_SIZE):
+        """Returns ``feature_func`` of every live slot as float16 features.
+
+        ``feature_func`` maps a ``(n, c, h, w)`` state tensor to ``(n, f)``
+        features and is only applied, a chunk at a time, to the slots whose
+        cached features are stale.
+        """
+        if self.feature_cache is None:
+            return torch.cat([feature_func(states).to('cpu', torch.float16)
+                              for _, states
+                              in self.iter_candidates(chunk_size)])
+        stale = self.feature_cache.stale(self.size, self.trunk_version,
+                                         self.feature_max_age)
+        for start in range(0, stale.shape[0], chunk_size):
+            slots = stale[start: start + chunk_size]
+            self.feature_cache.update(
+                slots, feature_func(self.m_states[slots]), self.trunk_version)
+        return self.feature_cache.m_values[: self.size]
+
+    def score_candidates(self, score_func):
+        """Returns ``score_func`` of every live slot, reusing cached scores.
+
+        ``score_func`` maps a ``(n, c, h, w)`` state tensor to ``n`` scores.
+        """
+        if self.score_cache is None:
+            return score_func(self.candidates())
+        stale = self.score_cache.stale(self.size, self.model_version,
+                                       self.score_max_age)
+        if stale.shape[0] == self.size:
+            scores = score_func(self.candidates())
+        elif stale.shape[0] > 0:
+            scores = score_func(self.m_states[stale])
+        if stale.shape[0] > 0:
+            self.score_cache.update(stale, scores, self.model_version)
+        return self.score_cache.m_values[: self.size]
+
+    def top_candidates(self, score_func, k, chunk_size=SCORE_CHUNK_SIZE,
+                       per_state=False):
+        """Indices of the ``k`` live slots with the highest scores.
+
+        ``score_func`` is applied to the whole pool at once, since rank
+        functions such as ``ens_normalized_BALD`` normalise over the states
+        they are given. With ``per_state`` set, the scores of each state are
+        assumed not to depend on the others: ``score_func`` is then applied
+        to one chunk of the pool at a time and only a bounded top-k is kept
+        between chunks.
+        """
+        if self.score_cache is not None or not per_state:
+            return top_k_indices(self.score_candidates(score_func), k,
+                                 chunk_size)
+        return top_k(((start, score_func(states)) for start, states
+                      in self.iter_candidates(chunk_size)), k)
+
+    def candidates(self):
+        """Returns the live region of the state storage.
+
+        For dense and memory-mapped storage this is a view, so scoring the
+        pool does not copy it.
+        """
+        return self.m_states[: self.size]
+
+    def iter_candidates(self, chunk_size):
+        """Yields ``(start, states)`` chunks covering every live slot once."""
+        for start in range(0, self.size, chunk_size):
+            yield start, self.m_states[start: min(start + chunk_size,
+                                                  self.size)]
+
+    def gather(self, indices, out=None):
+        """Gathers the transitions at ``indices``.
+
+        Returns ``(states, actions, rewards, dones)`` with the full stored
+        stack per state. When ``out`` holds four tensors of matching shape
+        the rows are written into them instead of fresh allocations.
+        """
+        fields = (self.m_states, self.m_actions, self.m_rewards, self.m_dones)
+        if out is None:
+            return tuple(field[indices] for field in fields)
+        for field, destination in zip(fields, out):
+            if isinstance(field, torch.Tensor):
+                torch.index_select(field, 0, indices, out=destination)
+            else:
+                destination.copy_(field[indices])
+        return out
+
+    def push_from(self, memory, indices):
+        """Copies the transitions at ``indices`` of ``memory`` into this one.
+
+        The rows are gathered straight into the destination slots, so no
+        intermediate batch is materialised for dense storage.
+        """
+        indices = torch.as_tensor(indices, dtype=torch.long).flatten()
+        num_transitions = indices.shape[0]
+        if num_transitions > self.capacity:
+            skipped = num_transitions - self.capacity
+            indices = indices[skipped:]
+            self.position = (self.position + skipped) % self.capacity
+            self.size = self.capacity
+            num_transitions = self.capacity
+        first = min(num_transitions, self.capacity - self.position)
+        self._gather_slice(self.position, memory, indices[:first])
+        if first < num_transitions:
+            self._gather_slice(0, memory, indices[first:])
+        self.position = (self.position + num_transitions) % self.capacity
+        self.size = min(self.size + num_transitions, self.capacity)
+        self._sync_meta()
+
+    def remove(self, indices):
+        """Drops the transitions at ``indices`` and compacts the live region.
+
+        Only the kept rows past the new end move, each into one of the holes
+        left below it, so the cost is one gather per field whatever the size.
+        """
+        keep = torch.ones(self.size, dtype=torch.bool)
+        keep[torch.as_tensor(indices, dtype=torch.long).flatten()] = False
+        new_size = int(keep.sum())
+        holes = (~keep[:new_size]).nonzero().flatten()
+        tail = keep[new_size:].nonzero().flatten() + new_size
+        if holes.shape[0] > 0:
+            self._copy_rows(holes, tail)
+        self.size = new_size
+        self.position = new_size % self.capacity
+        self._sync_meta()
+
+    def _copy_rows(self, destination, source):
+        for field in ('m_states', 'm_actions', 'm_rewards', 'm_dones'):
+            storage = getattr(self, field)
+            if isinstance(storage, torch.Tensor):
+                storage.index_copy_(0, destination, storage[source])
+            else:
+                storage.copy_rows(destination, source)
+        if self.score_cache is not None:
+            self.score_cache.copy_rows(destination, source)
+        if self.feature_cache is not None:
+            self.feature_cache.copy_rows(destination, source)
+
+    def _gather_slice(self, start, memory, indices):
+        end = start + indices.shape[0]
+        for field in ('m_states', 'm_actions', 'm_rewards', 'm_dones'):
+            source = getattr(memory, field)
+            destination = getattr(self, field)
+            if isinstance(source, torch.Tensor) and \
+                    isinstance(destination, torch.Tensor):
+                torch.index_select(source, 0, indices,
+                                   out=destination[start:end])
+            else:
+                destination[start:end] = source[indices]
+        self._invalidate(start, end)
+
+    def _write_slice(self, start, states, actions, rewards, dones):
+        end = start + states.shape[0]
+        self.m_states[start:end] = states
+        self.m_actions[start:end] = actions
+        self.m_rewards[start:end] = rewards
+        self.m_dones[start:end] = dones
+        self._invalidate(start, end)
+
+    def _invalidate(self, start, end):
+        if self.score_cache is not None:
+            self.score_cache.invalidate(start, end)
+        if self.feature_cache is not None:
+            self.feature_cache.invalidate(start, end)
+
+    def _sync_meta(self):
+        if self.m_meta is not None:
+            self.m_meta[4] = self.position
+            self.m_meta[5] = self.size
+
+    def flush(self):
+        """Writes the dirty pages of a memory-mapped memory back to disk."""
+        if self.m_meta is not None:
+            for array in self._memmaps:
+                array.flush()
+
+    def __len__(self):
+        return self.size